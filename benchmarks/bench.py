@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+# offline benchmark for gclient2nix
+#
+# runs gclient2nix without network and without nix:
+# - stub executables for nix, nix-build, nix-universal-prefetch, nix-prefetch-git, bsdtar
+#   with configurable latency. nix-build creates synthetic store paths in a temporary directory
+# - a local http server as stand-in for gitiles (?format=TEXT) and raw.githubusercontent.com
+# - synthetic DEPS trees with 10, 100, 1000 deps, deep recursedeps,
+#   and the real docs/examples/pdfium/DEPS
+#
+# every scenario runs twice: "cold" with an empty cache, "warm" with the cache of the cold run
+# every run is a separate process, so peak RSS is measured per run
+#
+# usage:
+#   python benchmarks/bench.py
+#   python benchmarks/bench.py --scenario deps-100 --latency nix-build=0.5
+#   python benchmarks/bench.py --save-baseline
+#   python benchmarks/bench.py -- --hash-only
+#
+# the exit code is 1 when a run is slower than the baseline
+
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+
+default_baseline_file = bench_dir + "/baseline.json"
+
+stub_tools = ["nix", "nix-build", "nix-universal-prefetch", "nix-prefetch-git", "bsdtar"]
+
+default_latency = {
+    "nix": 0.2,
+    "nix-build": 0.1,
+    "nix-universal-prefetch": 0.1,
+    "nix-prefetch-git": 0.1,
+    "bsdtar": 0.01,
+}
+
+# all stubs share this code
+# the stubs read $GCLIENT2NIX_BENCH_DIR/config.json
+stub_prelude = r'''
+import base64, hashlib, json, os, re, shutil, sys, time
+work_dir = os.environ["GCLIENT2NIX_BENCH_DIR"]
+with open(work_dir + "/config.json") as f:
+    config = json.load(f)
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+with open(work_dir + "/calls.log", "a") as f:
+    f.write(tool + "\n")
+time.sleep(config["latency"].get(tool, 0))
+
+def fake_hash(text):
+    return "sha256-" + base64.b64encode(hashlib.sha256(text.encode("utf8")).digest()).decode("ascii")
+
+def files_dir(url, rev):
+    return work_dir + "/files/" + re.sub(r"[^a-zA-Z0-9._]+", "-", re.sub(r"^[a-z+]+://", "", url)) + "/" + rev
+
+def store_path(url, rev, name="source"):
+    # synthetic store path with the files of the source
+    path = work_dir + "/store/" + hashlib.sha256(f"{url} {rev}".encode("utf8")).hexdigest()[:32] + "-" + name
+    if not os.path.exists(path):
+        temp_path = path + ".tmp-" + str(os.getpid())
+        source_files = files_dir(url, rev)
+        if os.path.isdir(source_files):
+            shutil.copytree(source_files, temp_path)
+        else:
+            os.makedirs(temp_path)
+        with open(temp_path + "/README", "w") as f:
+            f.write(f"{url} {rev}\n" * config["source_size"])
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # parallel call of the same source
+            shutil.rmtree(temp_path)
+    return path
+
+def get_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(dirpath + "/" + filename).st_size
+    return size
+
+def source_of_expr(expr):
+    def attr(name):
+        match = re.search(name + r' = "([^"]*)"', expr)
+        return match.group(1) if match else ""
+    url = attr("url") or f"https://github.com/{attr('owner')}/{attr('repo')}"
+    return url.removesuffix(".git"), attr("rev")
+'''
+
+stub_main = {
+    "nix-universal-prefetch": r'''
+print(fake_hash(json.dumps(args[1:])))
+''',
+    "nix-build": r'''
+if "-E" in args:
+    exprs = [args[args.index("-E") + 1]]
+else:
+    # file with an attribute set of fetchers, see realize_batch
+    with open(args[0]) as f:
+        exprs = re.split(r"\n(?=\w+ = )", f.read())[1:]
+out_link = args[args.index("--out-link") + 1] if "--out-link" in args else "result"
+for idx, expr in enumerate(exprs):
+    url, rev = source_of_expr(expr)
+    path = store_path(url, rev)
+    link = out_link if idx == 0 else f"{out_link}-{idx + 1}"
+    if os.path.lexists(link):
+        os.unlink(link)
+    os.symlink(path, link)
+    print(path)
+''',
+    "nix-prefetch-git": r'''
+url = args[args.index("--url") + 1]
+rev = args[args.index("--rev") + 1]
+print(json.dumps({ "url": url, "rev": rev, "path": store_path(url, rev), "hash": fake_hash(url + " " + rev) }, indent=2))
+''',
+    "nix": r'''
+if args[0] == "eval":
+    # nixpkgs_attr: attributes of the derivations, see nix_eval.py
+    expr = args[args.index("--expr") + 1]
+    print(json.dumps({
+        name: { "name": "source", "outputHash": fake_hash(attr), "__outPath": store_path("nixpkgs:" + attr, "") }
+        for name, attr in re.findall(r"(a[0-9]+) = get \((.*?)\);", expr)
+    }))
+elif args[0] == "path-info":
+    paths = [arg for arg in args[1:] if not arg.startswith("-")]
+    print(json.dumps({ path: { "narSize": get_size(path) } for path in paths }))
+else:
+    print(f"nix stub: unsupported command: {args}", file=sys.stderr)
+    sys.exit(1)
+''',
+    "bsdtar": r'''
+import tarfile
+archive = args[args.index("-f") + 1]
+member = args[args.index("--") + 1]
+with tarfile.open(archive) as tar:
+    sys.stdout.buffer.write(tar.extractfile(member).read())
+''',
+}
+
+def write_stubs(work_dir):
+    bin_dir = work_dir + "/bin"
+    os.makedirs(bin_dir)
+    for tool in stub_tools:
+        path = bin_dir + "/" + tool
+        with open(path, "w") as f:
+            f.write(f"#!{sys.executable}\n" + stub_prelude + stub_main[tool])
+        os.chmod(path, 0o755)
+    return bin_dir
+
+def files_dir(work_dir, url, rev):
+    # same as files_dir in stub_prelude
+    return work_dir + "/files/" + re.sub(r"[^a-zA-Z0-9._]+", "-", re.sub(r"^[a-z+]+://", "", url)) + "/" + rev
+
+def write_file(work_dir, url, rev, filepath, content):
+    path = files_dir(work_dir, url, rev) + "/" + filepath
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def fake_rev(name):
+    return hashlib.sha1(name.encode("utf8")).hexdigest()
+
+# scenarios
+# every scenario writes DEPS files to work_dir/files
+# and returns the --main-source-args of gclient2nix
+
+def bench_dep(name, github=False):
+    # return (url, dep)
+    rev = fake_rev(name)
+    if github:
+        url = f"https://github.com/bench/{name}.git"
+    else:
+        url = f"https://chromium.googlesource.com/bench/{name}.git"
+    return url, f"{url}@{rev}"
+
+def deps_file(deps, recursedeps=(), use_relative_paths=False):
+    lines = []
+    if use_relative_paths:
+        lines.append("use_relative_paths = True")
+    lines.append("vars = {")
+    lines.append("  'checkout_bench': True,")
+    lines.append("  'chromium_git': 'https://chromium.googlesource.com',")
+    lines.append("}")
+    lines.append("deps = {")
+    for path, (dep, condition) in deps.items():
+        if condition:
+            lines.append(f"  '{path}': {{ 'url': '{dep}', 'condition': '{condition}' }},")
+        else:
+            lines.append(f"  '{path}': '{dep}',")
+    lines.append("}")
+    lines.append("recursedeps = [")
+    for path in recursedeps:
+        lines.append(f"  '{path}',")
+    lines.append("]")
+    return "\n".join(lines) + "\n"
+
+def main_source_args(url, rev):
+    return ["fetcher=fetchFromGitiles", f"url={url}", f"rev={rev}"]
+
+def scenario_deps(work_dir, count):
+    # a flat tree with some recursedeps
+    # every 10th dep has its own DEPS file with 2 deps
+    main_url = "https://chromium.googlesource.com/bench/main"
+    main_rev = fake_rev("main")
+    deps = {}
+    recursedeps = []
+    conditions = [None, "checkout_linux", "checkout_linux and checkout_bench", "checkout_win"]
+    for i in range(count):
+        name = f"dep{i}"
+        url, dep = bench_dep(name, github=(i % 5 == 4))
+        deps[f"src/third_party/{name}"] = (dep, conditions[i % len(conditions)])
+        if i % 10 == 0:
+            recursedeps.append(f"src/third_party/{name}")
+            sub_deps = {
+                f"sub{j}": (bench_dep(f"{name}-sub{j}")[1], None)
+                for j in range(2)
+            }
+            write_file(work_dir, url.removesuffix(".git"), fake_rev(name), "DEPS", deps_file(sub_deps, use_relative_paths=True))
+    write_file(work_dir, main_url, main_rev, "DEPS", deps_file(deps, recursedeps))
+    return main_source_args(main_url, main_rev)
+
+def scenario_deep(work_dir, depth=50):
+    # a chain of recursedeps
+    # every level has 3 deps, one of them has the DEPS file of the next level
+    main_url = "https://chromium.googlesource.com/bench/main"
+    main_rev = fake_rev("deep")
+    url, rev = main_url, main_rev
+    path = "src"
+    for level in range(depth):
+        deps = {}
+        for j in range(3):
+            deps[f"{path}/level{level}-{j}"] = (bench_dep(f"level{level}-{j}")[1], None)
+        next_path = f"{path}/level{level}-0"
+        write_file(work_dir, url, rev, "DEPS", deps_file(deps, [next_path] if level < depth - 1 else []))
+        url = bench_dep(f"level{level}-0")[0].removesuffix(".git")
+        rev = fake_rev(f"level{level}-0")
+        path = next_path
+    return main_source_args(main_url, main_rev)
+
+def scenario_pdfium(work_dir):
+    # same source as docs/examples/pdfium/gclient2nix.sh
+    main_url = "https://pdfium.googlesource.com/pdfium"
+    main_rev = "39292f3808ea2e5e656969e00c3ce01abab2b2f1"
+    with open(repo_dir + "/docs/examples/pdfium/DEPS") as f:
+        write_file(work_dir, main_url, main_rev, "DEPS", f.read())
+    return main_source_args(main_url, main_rev)
+
+scenarios = {
+    "deps-10": lambda work_dir: scenario_deps(work_dir, 10),
+    "deps-100": lambda work_dir: scenario_deps(work_dir, 100),
+    "deps-1000": lambda work_dir: scenario_deps(work_dir, 1000),
+    "deep-recursedeps": scenario_deep,
+    "pdfium": scenario_pdfium,
+}
+
+class FileServer(http.server.ThreadingHTTPServer):
+    # stand-in for gitiles and raw.githubusercontent.com
+    # the url of the original request is in the path:
+    # http://127.0.0.1:port/chromium.googlesource.com/bench/dep0/+/rev/DEPS?format=TEXT
+    # http://127.0.0.1:port/raw.githubusercontent.com/owner/repo/rev/DEPS
+    daemon_threads = True
+
+    def __init__(self, work_dir, latency):
+        self.work_dir = work_dir
+        self.latency = latency
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FileRequestHandler)
+
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class FileRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.request_count_lock:
+            self.server.request_count += 1
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.lstrip("/")
+        if path.startswith("raw.githubusercontent.com/"):
+            _, owner, repo, rev, filepath = path.split("/", 4)
+            repo_url = f"github.com/{owner}/{repo}"
+            encode = lambda content: content
+        elif "/+/" in path:
+            repo_url, rest = path.split("/+/", 1)
+            rev, filepath = rest.split("/", 1)
+            if url.query != "format=TEXT":
+                return self.send_content(400, b"")
+            encode = base64.b64encode
+        else:
+            return self.send_content(404, b"")
+        file_path = files_dir(self.server.work_dir, repo_url, rev) + "/" + filepath
+        if not os.path.isfile(file_path):
+            return self.send_content(404, b"")
+        with open(file_path, "rb") as f:
+            self.send_content(200, encode(f.read()))
+
+    def send_content(self, status, content):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def run_driver(args):
+    # run gclient2nix.main in this process
+    # called by run_gclient2nix
+    result_file = args[0]
+    sys.argv = ["gclient2nix", *args[1:]]
+    sys.path.insert(0, repo_dir + "/src")
+    from gclient2nix import gclient2nix
+
+    # send requests for gitiles and github to the local server
+    base_url = os.environ["GCLIENT2NIX_BENCH_HTTP"]
+    gclient2nix.http_pool.url_rewrites.append(("https://", base_url + "/"))
+
+    # count all subprocesses, also git and tar
+    subprocess_count = 0
+    subprocess_count_lock = threading.Lock()
+    popen_init = subprocess.Popen.__init__
+    def counting_popen_init(*args, **kwargs):
+        nonlocal subprocess_count
+        with subprocess_count_lock:
+            subprocess_count += 1
+        popen_init(*args, **kwargs)
+    subprocess.Popen.__init__ = counting_popen_init
+
+    start = time.monotonic()
+    gclient2nix.main()
+    wall_time = time.monotonic() - start
+    with open(result_file, "w") as f:
+        json.dump({
+            "wall_time": wall_time,
+            "subprocesses": subprocess_count,
+            # linux: kilobytes
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }, f)
+
+def run_gclient2nix(work_dir, bin_dir, server, main_args, jobs, gclient2nix_args, log_file):
+    result_file = work_dir + "/result.json"
+    calls_file = work_dir + "/calls.log"
+    if os.path.exists(calls_file):
+        os.unlink(calls_file)
+    requests_before = server.request_count
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--driver", result_file,
+        "--output-file", work_dir + "/sources.json",
+        "--main-source-path", "src",
+        "--main-source-args", *main_args,
+        "--jobs", str(jobs),
+        # the stub sources have no git repos, so native hashing can only fail
+        "--native-hash", "off",
+        *gclient2nix_args,
+    ]
+    env = {
+        **os.environ,
+        "PATH": bin_dir + ":" + os.environ["PATH"],
+        "HOME": work_dir + "/home",
+        "GCLIENT2NIX_BENCH_DIR": work_dir,
+        "GCLIENT2NIX_BENCH_HTTP": server.base_url(),
+    }
+    with open(log_file, "w") as log:
+        subprocess.check_call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    with open(result_file) as f:
+        result = json.load(f)
+    tool_calls = {}
+    if os.path.exists(calls_file):
+        with open(calls_file) as f:
+            for tool in f.read().split():
+                tool_calls[tool] = tool_calls.get(tool, 0) + 1
+    result["tool_calls"] = tool_calls
+    result["http_requests"] = server.request_count - requests_before
+    return result
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} MB"
+
+def check_regressions(name, result, baseline, threshold):
+    # return a list of regressions
+    if baseline is None:
+        return []
+    regressions = []
+    if result["wall_time"] > baseline["wall_time"] * (1 + threshold):
+        regressions.append(f"wall time {result['wall_time']:.2f}s > {baseline['wall_time']:.2f}s")
+    if result["subprocesses"] > baseline["subprocesses"]:
+        regressions.append(f"subprocesses {result['subprocesses']} > {baseline['subprocesses']}")
+    if result["peak_rss"] > baseline["peak_rss"] * (1 + threshold):
+        regressions.append(f"peak RSS {format_size(result['peak_rss'])} > {format_size(baseline['peak_rss'])}")
+    return [f"{name}: {regression}" for regression in regressions]
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--driver":
+        return run_driver(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(prog='bench.py', description='offline benchmark for gclient2nix')
+    parser.add_argument('--scenario', action="append", choices=list(scenarios), help='default: all scenarios')
+    parser.add_argument('--latency', action="append", default=[], help='latency of a stub tool in seconds. example: nix-build=0.5')
+    parser.add_argument('--jobs', '-j', type=int, default=8, help='number of parallel jobs of gclient2nix. default: 8, independent of the number of cpus')
+    parser.add_argument('--http-latency', type=float, default=0.02, help='latency of the http server in seconds. default: 0.02')
+    parser.add_argument('--source-size', type=int, default=100, help='number of lines in the README file of every synthetic store path. default: 100')
+    parser.add_argument('--baseline', default=default_baseline_file, help='default: benchmarks/baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline. default: 0.2 = 20%%')
+    parser.add_argument('--keep', action='store_true', help='keep the work directories')
+    parser.add_argument('gclient2nix_args', nargs="*", help='more arguments for gclient2nix, after "--"')
+    args = parser.parse_args()
+
+    latency = dict(default_latency)
+    for tool_latency in args.latency:
+        tool, seconds = tool_latency.split("=", 1)
+        if not tool in stub_tools:
+            raise ValueError(f"unknown tool {tool!r}. known tools: {', '.join(stub_tools)}")
+        latency[tool] = float(seconds)
+
+    baselines = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    print(f"{'run':<24}  {'wall time':>9}  {'subprocesses':>12}  {'http':>5}  {'peak RSS':>9}")
+    for name in args.scenario or list(scenarios):
+        work_dir = tempfile.mkdtemp(prefix=f"gclient2nix-bench-{name}-")
+        try:
+            with open(work_dir + "/config.json", "w") as f:
+                json.dump({ "latency": latency, "source_size": args.source_size }, f)
+            os.makedirs(work_dir + "/store")
+            os.makedirs(work_dir + "/home")
+            bin_dir = write_stubs(work_dir)
+            main_args = scenarios[name](work_dir)
+            server = FileServer(work_dir, args.http_latency)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                for phase in ["cold", "warm"]:
+                    run_name = f"{name}/{phase}"
+                    log_file = work_dir + f"/{phase}.log"
+                    try:
+                        result = run_gclient2nix(work_dir, bin_dir, server, main_args, args.jobs, args.gclient2nix_args, log_file)
+                    except subprocess.CalledProcessError:
+                        with open(log_file) as f:
+                            print(f.read()[-4000:])
+                        raise
+                    results[run_name] = result
+                    print(f"{run_name:<24}  {result['wall_time']:>8.2f}s  {result['subprocesses']:>12}  {result['http_requests']:>5}  {format_size(result['peak_rss']):>9}")
+                    regressions += check_regressions(run_name, result, baselines.get(run_name), args.threshold)
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            if args.keep:
+                print(f"work directory: {work_dir}")
+            else:
+                shutil.rmtree(work_dir)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"wrote baseline file: {args.baseline}")
+
+    if regressions:
+        print("regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# microbenchmark for Repo.flatten and the output writer
+#
+# compares the old flatten (out |= dep.flatten(dep_path) at every level)
+# and json.dumps of the whole tree
+# with Repo.iter_output streamed by write_sources, as in main
+#
+# usage:
+#   python benchmarks/flatten.py
+#   python benchmarks/flatten.py --nodes 5000 --depth 500
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/src")
+
+from gclient2nix.gclient2nix import GitilesRepo, write_sources
+
+def make_tree(nodes, depth):
+    # a chain of "depth" recursedeps, the other nodes are leaves on the chain
+    repos = [GitilesRepo(f"https://chromium.googlesource.com/bench/dep{i}", f"{i:040x}") for i in range(nodes)]
+    main_repo = repos[0]
+    chain = [main_repo]
+    for repo in repos[1:depth]:
+        chain[-1].deps[f"src/level{len(chain)}"] = repo
+        chain.append(repo)
+    for i, repo in enumerate(repos[depth:]):
+        parent = chain[i % len(chain)]
+        parent.deps[f"src/leaf{i}"] = repo
+    return main_repo
+
+def old_flatten(repo, path):
+    # Repo.flatten before the iterator
+    out = {
+        path: repo.flatten_repr()
+    }
+    for dep_path, dep in repo.deps.items():
+        out |= old_flatten(dep, dep_path)
+    return out
+
+def measure(function, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+def measure_peak_memory(function):
+    # peak of the memory allocated by python in function, in bytes
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(prog='flatten.py')
+    parser.add_argument('--nodes', type=int, default=5000, help='number of sources. default: 5000')
+    parser.add_argument('--depth', type=int, default=500, help='depth of the tree. default: 500')
+    parser.add_argument('--rounds', type=int, default=5, help='report the best of this number of rounds. default: 5')
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), args.depth * 4))
+    main_repo = make_tree(args.nodes, args.depth)
+
+    old_output = json.dumps(old_flatten(main_repo, "src"), indent=2, default = vars) + "\n"
+    new_output = io.StringIO()
+    write_sources(new_output, main_repo.iter_output("src"))
+    if old_output != new_output.getvalue():
+        raise Exception("different output")
+
+    null_file = open(os.devnull, "w")
+    def run_old():
+        null_file.write(json.dumps(old_flatten(main_repo, "src"), indent=2, default = vars) + "\n")
+    def run_new():
+        write_sources(null_file, main_repo.iter_output("src"))
+
+    print(f"{args.nodes} sources, depth {args.depth}, best of {args.rounds} rounds")
+    old_flatten_time = measure(lambda: old_flatten(main_repo, "src"), args.rounds)
+    new_flatten_time = measure(lambda: main_repo.flatten("src"), args.rounds)
+    print(f"flatten:          old {old_flatten_time * 1000:8.1f} ms  new {new_flatten_time * 1000:8.1f} ms")
+    old_write_time = measure(run_old, args.rounds)
+    new_write_time = measure(run_new, args.rounds)
+    print(f"flatten + write:  old {old_write_time * 1000:8.1f} ms  new {new_write_time * 1000:8.1f} ms")
+    old_memory = measure_peak_memory(run_old)
+    new_memory = measure_peak_memory(run_new)
+    print(f"peak memory:      old {old_memory / 1024 / 1024:8.1f} MB  new {new_memory / 1024 / 1024:8.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,3 @@
 from .gclient2nix import *
+
+main()
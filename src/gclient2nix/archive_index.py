@@ -0,0 +1,69 @@
+# member index of archive store paths
+#
+# some sources are archives, for example
+# nixpkgs_attr=chromium.browser.src -> /nix/store/...-chromium-124.0.6367.60.tar.zstd
+#
+# reading one file from such an archive needs decompression from the start of the archive,
+# which is slow when the file is at the end of the archive.
+# so we scan every archive only once, and store in the cache database (see cache_db.py)
+# - the names and sizes of all members
+# - the contents of small metadata files like DEPS or package-lock.json
+# then Repo.get_file needs no decompression for these files
+#
+# "bsdtar -c @archive" converts any archive format supported by libarchive (also zstd)
+# to an uncompressed tar stream, which is read by the tarfile module
+
+import os
+import shlex
+import subprocess
+import sys
+import tarfile
+
+# contents of these files are stored in the index
+# other files are extracted with bsdtar on demand, and are stored after the first read
+indexed_file_names = {
+    "DEPS",
+    "package.json",
+    "package-lock.json",
+    "yarn.lock",
+    "pnpm-lock.yaml",
+    "Cargo.lock",
+    ".gitmodules",
+}
+
+# larger files are not stored in the index
+max_indexed_file_size = 64 * 1024 * 1024
+
+def scan_archive(archive_path):
+    # yield (name, size, content)
+    # content is None for directories and for files which are not indexed
+    cmd = ["bsdtar", "-c", "-f", "-", "--format", "pax", "@" + archive_path]
+    print(shlex.join(cmd), file=sys.stderr)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        # "r|": stream, no seeking
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            for member in tar:
+                content = None
+                if member.isfile() and os.path.basename(member.name) in indexed_file_names and member.size <= max_indexed_file_size:
+                    content = tar.extractfile(member).read()
+                name = member.name + "/" if member.isdir() else member.name
+                yield name, member.size, content
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def get_toplevel_path(names):
+    # top-level folder, usually "source/"
+    # "" when the members are not all in one folder, for example in 7zip source
+    toplevel = None
+    for name in names:
+        first, separator, _ = name.partition("/")
+        if not separator or (toplevel is not None and first != toplevel):
+            return ""
+        toplevel = first
+    if toplevel is None:
+        return ""
+    return toplevel + "/"
@@ -0,0 +1,458 @@
+# persistent cache in a sqlite database
+#
+# this replaces ~/.cache/gclient2nix/cache.txt
+# which was loaded completely on startup and rewritten completely on exit.
+# now every cache entry is written right after it was computed,
+# so a crash loses nothing,
+# and multiple gclient2nix processes can share one cache file (WAL mode)
+#
+# the old text format is still supported by import_text_cache and export_text_cache
+#
+# text format: blocks separated by "\n\n\n\n"
+# first line of a block: the cache key (a json string)
+# second line of a block: the cache value (a json object with "hash" and extra data)
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from . import archive_index
+from .depot_tools import gclient_utils
+
+# version of the database schema and of the cache key format
+# version 1: canonical cache keys, source index by (url, rev)
+# version 2: member index of archive store paths
+# version 3: toplevel_path of archives, instead of the first member
+# version 4: store_path_size_unit
+schema_version = 4
+
+# these fetchers produce a source tree of a git revision
+# so we can read files from any of their store paths
+git_fetchers = ("fetchgit", "fetchFromGitiles", "fetchFromGitHub")
+
+def normalize_url(url):
+    url = url.rstrip("/")
+    if url.endswith(".git"):
+        url = url[:-4]
+    return url
+
+def remove_hashes(dep):
+    return { attr: dep[attr] for attr in dep if attr != "hash" and attr != "sha256" }
+
+def canonical_cache_key(dep):
+    # the same source must always have the same cache key
+    # independent of the order of arguments
+    dep = remove_hashes(dep)
+    if "__nixpkgs_attr" in dep:
+        # Repo.prefetch replaces nixpkgs_attr with the attributes of the derivation
+        dep = { "fetcher": None, "nixpkgs_attr": dep["__nixpkgs_attr"] }
+    if isinstance(dep.get("url"), str):
+        dep["url"] = normalize_url(dep["url"])
+    return json.dumps(dep, sort_keys=True, separators=(",", ":"))
+
+def canonicalize_key(key):
+    # convert a cache key from an old version of gclient2nix
+    # some keys have a prefix like "yarn-" or "npm-"
+    idx = key.find("{")
+    if idx == -1:
+        return key
+    try:
+        dep = json.loads(key[idx:])
+    except json.JSONDecodeError:
+        return key
+    if not isinstance(dep, dict):
+        return key
+    return key[:idx] + canonical_cache_key(dep)
+
+def source_of_key(key):
+    # secondary index: return (url, rev) of a git source, or (None, None)
+    # the fetcher is not part of the index
+    # so fetchgit, fetchFromGitiles and fetchFromGitHub can share store paths
+    if not key.startswith("{"):
+        return None, None
+    dep = json.loads(key)
+    if dep.get("fetcher") not in git_fetchers:
+        return None, None
+    rev = dep.get("rev")
+    if not isinstance(rev, str) or not gclient_utils.IsFullGitSha(rev):
+        # only commit hashes are immutable
+        return None, None
+    if dep["fetcher"] == "fetchFromGitHub":
+        url = f"https://github.com/{dep.get('owner')}/{dep.get('repo')}"
+    else:
+        url = dep.get("url")
+    if not isinstance(url, str):
+        return None, None
+    return normalize_url(url), rev
+
+class CacheDatabase:
+    def __init__(self, path):
+        self.path = path
+        # one connection for all threads, guarded by self.lock
+        self.lock = threading.Lock()
+        # timeout: wait for locks held by other gclient2nix processes
+        # isolation_level=None: we use explicit transactions
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WAL + synchronous=NORMAL is durable against process crashes
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                hash TEXT,
+                extra_data TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+        # small files like DEPS, read by Repo.get_file
+        # revisions are immutable, so these files never change
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS source_files (
+                url TEXT,
+                rev TEXT,
+                path TEXT,
+                content BLOB,
+                PRIMARY KEY (url, rev, path)
+            )
+        """)
+        # member index of archive store paths, see archive_index.py
+        self.create_archives_table()
+        # content_hash: sha256 of the content in archive_files, or NULL
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS archive_members (
+                store_path TEXT,
+                name TEXT,
+                size INTEGER,
+                content_hash TEXT,
+                PRIMARY KEY (store_path, name)
+            )
+        """)
+        # content-addressed: the same file in multiple versions of an archive is stored once
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS archive_files (
+                content_hash TEXT PRIMARY KEY,
+                content BLOB
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS imported_files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER
+            )
+        """)
+        self.migrate()
+
+    def migrate(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                self.migrate_to_1()
+            if version < 3:
+                self.migrate_to_3()
+            if version < 4:
+                self.migrate_to_4()
+            self.connection.execute(f"PRAGMA user_version = {schema_version}")
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def migrate_to_1(self):
+        # add the source index, and convert old cache keys to canonical cache keys
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(cache)")]
+        if not "url" in columns:
+            self.connection.execute("ALTER TABLE cache ADD COLUMN url TEXT")
+            self.connection.execute("ALTER TABLE cache ADD COLUMN rev TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_source ON cache (url, rev)")
+        rows = self.connection.execute("SELECT key, hash, extra_data FROM cache").fetchall()
+        count = 0
+        for key, hash, extra_data in rows:
+            new_key = canonicalize_key(key)
+            if new_key != key:
+                self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                count += 1
+            self._put(new_key, hash, json.loads(extra_data))
+        if count > 0:
+            print(f"cache_db: converted {count} cache keys to canonical cache keys")
+
+    def create_archives_table(self):
+        # toplevel_path: usually "source/", see archive_index.get_toplevel_path
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS archives (
+                store_path TEXT PRIMARY KEY,
+                toplevel_path TEXT
+            )
+        """)
+
+    def migrate_to_3(self):
+        # the first member is not enough to find the toplevel path,
+        # so the archives are scanned again on the next read
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(archives)")]
+        if "first_member" in columns:
+            self.connection.execute("DROP TABLE archives")
+            self.connection.execute("DELETE FROM archive_members")
+            self.create_archives_table()
+
+    def migrate_to_4(self):
+        # tag the sizes of old versions with their unit, see _put
+        rows = self.connection.execute("SELECT key, hash, extra_data FROM cache WHERE extra_data LIKE '%store_path_size%'").fetchall()
+        for key, hash, extra_data in rows:
+            self._put(key, hash, json.loads(extra_data))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, key):
+        # return (hash, extra_data) or None
+        with self.lock:
+            row = self.connection.execute("SELECT hash, extra_data FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, key, hash, extra_data):
+        # merge with the existing entry
+        # which can be written by another gclient2nix process
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._put(key, hash, extra_data)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def put_many(self, entries):
+        # entries: iterable of (key, hash, extra_data)
+        # one transaction for all entries
+        count = 0
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for key, hash, extra_data in entries:
+                    self._put(key, hash, extra_data)
+                    count += 1
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return count
+
+    def _put(self, key, hash, extra_data):
+        if "store_path_size" in extra_data and not "store_path_size_unit" in extra_data:
+            # old versions and cache.txt files: "du -sb" size, not the NAR size (see store_size.py)
+            # the sizes are similar, so they are still good for the estimates in schedule.py
+            extra_data = { **extra_data, "store_path_size_unit": "du" }
+        row = self.connection.execute("SELECT hash, extra_data FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            if hash is None:
+                hash = row[0]
+            extra_data = { **json.loads(row[1]), **extra_data }
+        url, rev = source_of_key(key)
+        self.connection.execute(
+            "INSERT INTO cache (key, hash, extra_data, url, rev) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET hash = excluded.hash, extra_data = excluded.extra_data",
+            (key, hash, json.dumps(extra_data), url, rev),
+        )
+
+    def find_store_paths(self, key):
+        # secondary index: find store paths of the same git source
+        # which was fetched by a different fetcher, or with different arguments
+        # the hashes can be different, but the files are the same
+        url, rev = source_of_key(key)
+        if url is None:
+            return []
+        with self.lock:
+            rows = self.connection.execute("SELECT extra_data FROM cache WHERE url = ? AND rev = ?", (url, rev)).fetchall()
+        store_paths = []
+        for (extra_data,) in rows:
+            store_path = json.loads(extra_data).get("store_path")
+            if store_path:
+                store_paths.append(store_path)
+        return store_paths
+
+    def get_store_path_sizes(self):
+        # return a list of (url, store_path_size, prefetch_time) of all git sources with a known size
+        # prefetch_time is None for sources from old versions
+        # the size is the NAR size, or the "du -sb" size of old versions (see store_path_size_unit)
+        # for the size estimates of new revisions, see schedule.py
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT url, extra_data FROM cache WHERE url IS NOT NULL AND extra_data LIKE '%store_path_size%'"
+            ).fetchall()
+        sizes = []
+        for url, extra_data in rows:
+            extra_data = json.loads(extra_data)
+            size = extra_data.get("store_path_size")
+            if isinstance(size, int):
+                sizes.append((url, size, extra_data.get("prefetch_time")))
+        return sizes
+
+    def get_source_file(self, key, path):
+        # return bytes or None
+        url, rev = source_of_key(key)
+        if url is None:
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT content FROM source_files WHERE url = ? AND rev = ? AND path = ?", (url, rev, path)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_source_file(self, key, path, content):
+        url, rev = source_of_key(key)
+        if url is None:
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO source_files (url, rev, path, content) VALUES (?, ?, ?, ?)",
+                (url, rev, path, content),
+            )
+
+    def is_archive_indexed(self, store_path):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM archives WHERE store_path = ?", (store_path,)).fetchone()
+        return row is not None
+
+    def get_archive_toplevel_path(self, store_path):
+        with self.lock:
+            row = self.connection.execute("SELECT toplevel_path FROM archives WHERE store_path = ?", (store_path,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_archive_index(self, store_path, members):
+        # members: iterable of (name, size, content)
+        # the members are collected before the transaction,
+        # so the slow scan of the archive does not hold the lock of the database,
+        # which is shared by all threads and by other gclient2nix processes.
+        # one short transaction, so an interrupted scan leaves no partial index
+        # return the number of members
+        member_rows = []
+        file_rows = {}
+        for name, size, content in members:
+            content_hash = None
+            if content is not None:
+                content_hash = hashlib.sha256(content).hexdigest()
+                file_rows[content_hash] = content
+            member_rows.append((store_path, name, size, content_hash))
+        toplevel_path = archive_index.get_toplevel_path(row[1] for row in member_rows)
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("DELETE FROM archive_members WHERE store_path = ?", (store_path,))
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO archive_files (content_hash, content) VALUES (?, ?)",
+                    file_rows.items(),
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO archive_members (store_path, name, size, content_hash) VALUES (?, ?, ?, ?)",
+                    member_rows,
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO archives (store_path, toplevel_path) VALUES (?, ?)",
+                    (store_path, toplevel_path),
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return len(member_rows)
+
+    def _put_archive_member(self, store_path, name, size, content):
+        content_hash = None
+        if content is not None:
+            content_hash = hashlib.sha256(content).hexdigest()
+            self.connection.execute(
+                "INSERT OR IGNORE INTO archive_files (content_hash, content) VALUES (?, ?)",
+                (content_hash, content),
+            )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO archive_members (store_path, name, size, content_hash) VALUES (?, ?, ?, ?)",
+            (store_path, name, size, content_hash),
+        )
+
+    def get_archive_member(self, store_path, name):
+        # return (size, content) or None if the member does not exist
+        # content is None if the content is not stored
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT archive_members.size, archive_files.content FROM archive_members "
+                "LEFT JOIN archive_files ON archive_members.content_hash = archive_files.content_hash "
+                "WHERE archive_members.store_path = ? AND archive_members.name = ?",
+                (store_path, name),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def put_archive_member_content(self, store_path, name, content):
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM archive_members WHERE store_path = ? AND name = ?", (store_path, name)).fetchone()
+            if row is None:
+                return
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._put_archive_member(store_path, name, row[0], content)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def items(self):
+        # yield (key, hash, extra_data)
+        with self.lock:
+            rows = self.connection.execute("SELECT key, hash, extra_data FROM cache ORDER BY rowid").fetchall()
+        for key, hash, extra_data in rows:
+            yield key, hash, json.loads(extra_data)
+
+    def is_imported(self, path):
+        # return True if this file was imported, and was not modified since then
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute("SELECT mtime, size FROM imported_files WHERE path = ?", (path,)).fetchone()
+        return row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size
+
+    def import_text_cache(self, path):
+        # import a cache.txt file from an old version of gclient2nix
+        # return the number of imported entries
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with open(path) as f:
+            text = f.read()
+        def get_entries():
+            for block in text.split("\n\n\n\n"):
+                block_parts = block.strip().split("\n")
+                if len(block_parts) < 2:
+                    continue
+                key = canonicalize_key(block_parts[0])
+                value = json.loads(block_parts[1])
+                hash = value.pop("hash", None)
+                yield key, hash, value
+        count = self.put_many(get_entries())
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO imported_files (path, mtime, size) VALUES (?, ?, ?)",
+                (path, stat.st_mtime, stat.st_size),
+            )
+        return count
+
+    def export_text_cache(self, path):
+        # write the cache in the old text format
+        # return the number of exported entries
+        def get_cache_entry_str(entry):
+            key, hash, extra_data = entry
+            cache_value = {
+                "hash": hash,
+                **extra_data,
+            }
+            return key + "\n" + json.dumps(cache_value)
+        blocks = list(map(get_cache_entry_str, self.items()))
+        with open(path, "w") as f:
+            f.write("\n\n\n\n".join(blocks) + "\n")
+        return len(blocks)
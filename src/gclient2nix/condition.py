@@ -0,0 +1,156 @@
+# compiled conditions of DEPS files
+#
+# same results and errors as gclient_eval.EvaluateCondition, but faster:
+# gclient_eval.EvaluateCondition parses the condition on every call,
+# and parses every string variable again for every reference.
+# chromium DEPS files have hundreds of conditions,
+# built from a few expressions like "checkout_linux and not build_with_chromium"
+#
+# here every distinct condition is parsed once into a tree of closures,
+# and results are memoized per (condition, frozen variables)
+#
+# usage:
+#   variables = freeze(repo_vars)
+#   evaluate(condition, variables)
+
+import ast
+import threading
+
+from .depot_tools import gclient_utils
+
+allowed_names = {'None': None, 'True': True, 'False': False}
+
+# condition -> function(variables, referenced_variables)
+compiled_conditions = {}
+
+# (condition, frozen variables) -> result
+results = {}
+
+lock = threading.Lock()
+
+def freeze(variables):
+    return gclient_utils.freeze(variables)
+
+def evaluate(condition, variables):
+    # variables: from freeze(variables)
+    key = (condition, variables)
+    try:
+        return results[key]
+    except KeyError:
+        pass
+    # errors are not memoized, so they are raised again on the next call
+    result = get_compiled(condition)(variables, frozenset())
+    with lock:
+        results[key] = result
+    return result
+
+def get_compiled(condition):
+    function = compiled_conditions.get(condition)
+    if function is None:
+        function = compile_condition(condition)
+        with lock:
+            compiled_conditions[condition] = function
+    return function
+
+def compile_condition(condition):
+    # return function(variables, referenced_variables)
+    # the errors are raised on evaluation, in the same order as in gclient_eval.EvaluateCondition
+    main_node = ast.parse(condition, mode='eval')
+    if isinstance(main_node, ast.Expression):
+        main_node = main_node.body
+
+    def unexpected_node(node):
+        message = 'unexpected AST node: %s %s (inside %r)' % (node, ast.dump(node), condition)
+        def function(variables, referenced_variables):
+            raise ValueError(message)
+        return function
+
+    def compile_name(name):
+        def function(variables, referenced_variables):
+            if name in referenced_variables:
+                raise ValueError('invalid cyclic reference to %r (inside %r)' % (name, condition))
+            if name in allowed_names:
+                return allowed_names[name]
+            if name in variables:
+                value = variables[name]
+                # Allow using "native" types, without wrapping everything in strings.
+                if not isinstance(value, str):
+                    return value
+                # Recursively evaluate the variable reference.
+                # not memoized: the result depends on referenced_variables (cyclic references)
+                return get_compiled(value)(variables, referenced_variables | {name})
+            # Implicitly convert unrecognized names to strings.
+            return name
+        return function
+
+    def compile_bool_op(operator_name, combine, operands):
+        def function(variables, referenced_variables):
+            # no short-circuit: all operands are evaluated and checked
+            bool_values = []
+            for operand in operands:
+                bool_values.append(operand(variables, referenced_variables))
+                if not isinstance(bool_values[-1], bool):
+                    raise ValueError('invalid "%s" operand %r (inside %r)' % (operator_name, bool_values[-1], condition))
+            return combine(bool_values)
+        return function
+
+    def compile_node(node, allow_tuple=False):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, bool, type(None))):
+            value = node.value
+            return lambda variables, referenced_variables: value
+
+        if isinstance(node, ast.Tuple) and allow_tuple:
+            elements = [compile_node(element) for element in node.elts]
+            return lambda variables, referenced_variables: tuple(element(variables, referenced_variables) for element in elements)
+
+        if isinstance(node, ast.Name):
+            return compile_name(node.id)
+
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or):
+            return compile_bool_op("or", any, [compile_node(value) for value in node.values])
+
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            return compile_bool_op("and", all, [compile_node(value) for value in node.values])
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = compile_node(node.operand)
+            def function(variables, referenced_variables):
+                value = operand(variables, referenced_variables)
+                if not isinstance(value, bool):
+                    raise ValueError('invalid "not" operand %r (inside %r)' % (value, condition))
+                return not value
+            return function
+
+        if isinstance(node, ast.Compare):
+            if len(node.ops) != 1:
+                message = 'invalid compare: exactly 1 operator required (inside %r)' % (condition)
+            elif len(node.comparators) != 1:
+                message = 'invalid compare: exactly 1 comparator required (inside %r)' % (condition)
+            else:
+                message = None
+            if message:
+                def function(variables, referenced_variables):
+                    raise ValueError(message)
+                return function
+            op = node.ops[0]
+            left = compile_node(node.left)
+            right = compile_node(node.comparators[0], allow_tuple=isinstance(op, ast.In))
+            if isinstance(op, ast.Eq):
+                compare = lambda left_value, right_value: left_value == right_value
+            elif isinstance(op, ast.NotEq):
+                compare = lambda left_value, right_value: left_value != right_value
+            elif isinstance(op, ast.In):
+                compare = lambda left_value, right_value: left_value in right_value
+            else:
+                message = 'unexpected operator: %s %s (inside %r)' % (op, ast.dump(node), condition)
+                def compare(left_value, right_value):
+                    raise ValueError(message)
+            def function(variables, referenced_variables):
+                left_value = left(variables, referenced_variables)
+                right_value = right(variables, referenced_variables)
+                return compare(left_value, right_value)
+            return function
+
+        return unexpected_node(node)
+
+    return compile_node(main_node)
@@ -25,13 +25,35 @@ import json
 import sys
 import argparse
 import hashlib
+import heapq
 import shlex
+import threading
+import time
+import multiprocessing
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from codecs import iterdecode
 from datetime import datetime
 from urllib.request import urlopen
 
 from .depot_tools import gclient_eval
 from .depot_tools import gclient_utils
+from .cache_db import CacheDatabase
+from .cache_db import canonical_cache_key
+from .cache_db import remove_hashes
+from .cache_db import normalize_url
+from . import nar
+from . import git_mirror
+from . import archive_index
+from . import trace
+from . import condition
+from .journal import Journal
+from .nix_eval import NixEvaluator
+from .http_client import HttpClient
+from .process_runner import ProcessRunner
+from .store_size import StoreSizeProvider
+from .schedule import SizeEstimator, PrefetchProgress, estimate_duration, format_size, format_duration
 
 nix_universal_prefetch_bin = "nix-universal-prefetch"
 
@@ -39,16 +61,144 @@ nix_bin = "nix"
 
 nix_build_bin = "nix-build"
 
+# evaluates nixpkgs_attr, see nix_eval.py
+# all external tools run in process_runner, see process_runner.py
+process_runner = ProcessRunner(gclient_utils.NumLocalCpus())
+
+nix_evaluator = NixEvaluator(nix_bin, runner=process_runner)
+git_mirror.runner = process_runner
+
+# store_path_size, see store_size.py
+store_size_provider = StoreSizeProvider(nix_bin, runner=process_runner, jobs=gclient_utils.NumLocalCpus())
+
+# keys of realized sources without store_path_size
+# all sizes are measured with one store_size_provider call, see measure_store_sizes
+unsized_keys = set()
+unsized_keys_lock = threading.Lock()
+
 # TODO merge
 cache = {}
 cache_extra_data = {}
 
-def remove_hashes(dep):
-    return { attr: dep[attr] for attr in dep if attr != "hash" and attr != "sha256" }
+# persistent cache, see cache_db.py
+# cache and cache_extra_data are filled on demand from cache_db
+cache_db = None
+
+def load_cache_entry(key):
+    if cache_db is None or key in cache:
+        return
+    with trace.span("cache load"):
+        entry = cache_db.get(key)
+    if entry is None:
+        return
+    hash, extra_data = entry
+    if hash is not None:
+        cache[key] = hash
+    cache_extra_data[key] = { **extra_data, **cache_extra_data.get(key, {}) }
+    forget_missing_store_path(key)
+
+def forget_missing_store_path(key):
+    # the cached store path can be garbage-collected,
+    # or come from another machine (--import-cache)
+    # then the source is realized again, when it is needed
+    extra_data = cache_extra_data.get(key, {})
+    store_path = extra_data.get("store_path")
+    if store_path and not os.path.exists(store_path):
+        print(f"cached store path is missing: {store_path}")
+        for name in ("store_path", "store_path_size", "store_path_size_unit"):
+            extra_data.pop(name, None)
+
+def find_store_path(key):
+    if cache_db is None:
+        return None
+    for store_path in cache_db.find_store_paths(key):
+        if os.path.exists(store_path):
+            print(f"using store path of the same source: {store_path}")
+            return store_path
+    return None
+
+def save_cache_entry(key):
+    if cache_db is None:
+        return
+    with trace.span("cache save"):
+        cache_db.put(key, cache.get(key), cache_extra_data.get(key, {}))
+
+# one lock per cache key, so parallel prefetches of the same source
+# (same url and rev at different paths) run only once
+prefetch_locks = {}
+prefetch_locks_lock = threading.Lock()
+
+def get_prefetch_lock(key):
+    with prefetch_locks_lock:
+        if not key in prefetch_locks:
+            prefetch_locks[key] = threading.Lock()
+        return prefetch_locks[key]
+
+# native hashing, see nar.py
+# "off": use nix-universal-prefetch
+# "on": use nar.py, and nix-universal-prefetch for unsupported sources
+# "verify": use nix-universal-prefetch, and compare its hashes with nar.py
+#   the result is stored in the cache ("native_hash"), so every source is verified only once
+native_hash_mode = "verify"
+native_hash_executor = None
+native_hash_stats = { "match": 0, "mismatch": 0, "unsupported": 0, "failed": 0 }
+native_hash_verified = set()
+
+# local git mirrors, see git_mirror.py
+# None: dont use mirrors
+git_mirror_root = None
+
+# shared http client for gitiles and github, see http_client.py
+http_pool = HttpClient()
+# files from fetch_files: (cache key, filepath) -> file content
+fetched_files = {}
+
+# --plan: evaluate DEPS files without nix-universal-prefetch and nix-build
+plan_mode = False
+# sources with a DEPS file which could not be read without prefetch
+plan_unevaluated_paths = []
+
+class PlanFileUnavailable(Exception):
+    pass
+
+# progress journal, see journal.py and --resume
+journal = None
+# files from the journal: (cache key, filepath) -> file content
+journal_files = {}
+
+def journal_record(step, **data):
+    if journal:
+        journal.record(step, **data)
+
+def replay_journal():
+    # restore the finished steps of a crashed run
+    counts = {}
+    for record in journal.replay():
+        step = record.get("step")
+        key = record.get("key")
+        if step == "file":
+            content = record["content"]
+            if record.get("encoding") == "base64":
+                content = base64.b64decode(content)
+            journal_files[(key, record["path"])] = content
+        elif step == "hash":
+            cache[key] = record["hash"]
+        elif step == "store_path":
+            if not os.path.exists(record["store_path"]):
+                # garbage-collected since the crash
+                continue
+            cache_extra_data.setdefault(key, {})["store_path"] = record["store_path"]
+        elif step == "size":
+            cache_extra_data.setdefault(key, {})["store_path_size"] = record["size"]
+            cache_extra_data[key]["store_path_size_unit"] = record.get("unit", "du")
+        else:
+            continue
+        counts[step] = counts.get(step, 0) + 1
+    return counts
 
 def cache_key(dep):
-    # TODO sort keys
-    return json.dumps(remove_hashes(dep))
+    # sorted keys, normalized url, without hashes. see cache_db.py
+    return canonical_cache_key(dep)
 
 class Repo:
     def __init__(self):
@@ -58,70 +208,147 @@ class Repo:
         # TODO handle recurse
         self.recurse = False
         self.args = {}
+        # names of the platforms which need this source. see --platform-matrix
+        self.platforms = []
 
     def get_file(self, filepath):
-        # TODO directory vs archive -> extract only needed files or zipmount
+        with trace.span("get_file", path=filepath):
+            return self._get_file(filepath)
+
+    def _get_file(self, filepath):
         key = cache_key(self.flatten_repr())
-        if not "store_path" in cache_extra_data[key]:
+        if (key, filepath) in journal_files:
+            return journal_files[(key, filepath)]
+        # small files like DEPS are cached by (url, rev, path)
+        file_content = get_cached_source_file(key, filepath)
+        if file_content is None:
+            # fetched in parallel, see fetch_files
+            file_content = fetched_files.pop((key, filepath), None)
+        if file_content is None:
+            file_content = self.read_file(key, filepath)
+            put_cached_source_file(key, filepath, file_content)
+        if isinstance(file_content, bytes):
+            # not utf8 text, see decode_file_content. json needs a string
+            journal_record("file", key=key, path=filepath, content=base64.b64encode(file_content).decode("ascii"), encoding="base64")
+        else:
+            journal_record("file", key=key, path=filepath, content=file_content)
+        return file_content
+
+    def read_file(self, key, filepath):
+        load_cache_entry(key)
+        forget_missing_store_path(key)
+        store_path = cache_extra_data.get(key, {}).get("store_path")
+        if not store_path:
+            # the same git revision can be in the store from a different fetcher
+            store_path = find_store_path(key)
+        if not store_path:
+            # fetch only this file, not the whole source
+            file_content = self.fetch_file(filepath)
+            if file_content is not None:
+                return file_content
+            if plan_mode:
+                raise PlanFileUnavailable(f"reading {filepath} needs a prefetch")
             print("Repo.get_file: calling Repo.prefetch to set store_path")
             self.prefetch()
-        if not "store_path" in cache_extra_data[key]:
+            store_path = cache_extra_data.get(key, {}).get("store_path")
+        if not store_path:
             raise Exception("Repo.prefetch failed to set store_path")
-        store_path = cache_extra_data[key]["store_path"]
-        if not os.path.exists(store_path):
-            raise Exception(f"missing store_path {store_path}")
-        if os.path.isdir(store_path):
-            with open(store_path + "/" + filepath) as f:
-                return f.read()
-        # note: this hangs: bsdtar -t -f chromium-124.0.6367.60.tar.zstd | head -n1
-        # get top-level folder, usually "source/"
-        # TODO top-level folder can be missing, for example in 7zip source
-        # $ tar tf /nix/store/anc9r9znhghg3x112r1vcra5k0x7dk1z-chromium-124.0.6367.60.tar.zstd | head -n1
-        # source/
-        cmd = f"tar -t -f {store_path} | head -n1"
-        #print(shlex.join(cmd), file=sys.stderr)
-        print(cmd)
-        toplevel_path = subprocess.check_output(cmd, shell=True, encoding="utf8").strip()
-        print("toplevel_path", repr(toplevel_path))
-        if toplevel_path[-1] != "/":
-            # first file in archive is not a directory
-            # -> assume there is not toplevel dir
-            toplevel_path = ""
-        # "bsdtar --fast-read" is 1000x faster than "tar"
-        # if the extracted file is at the beginning of the archive
-        # https://unix.stackexchange.com/questions/61461/how-to-extract-specific-files-from-tar-gz
-        # https://unix.stackexchange.com/a/775952/295986
-        # $ bsdtar --fast-read -x -f chromium-124.0.6367.60.tar.zstd -- source/DEPS
-        cmd = ["bsdtar", "--fast-read", "-x", "-f", store_path, "--to-stdout", "--", toplevel_path + filepath]
-        print(shlex.join(cmd), file=sys.stderr)
-        file_content = subprocess.check_output(cmd)
-        print("file_content:", repr(file_content[0:100]) + "...")
+        if plan_mode and not os.path.exists(store_path):
+            raise PlanFileUnavailable(f"reading {filepath} needs a build of {store_path}")
+        return read_store_file(store_path, filepath)
+
+    def fetch_file(self, filepath):
+        # get one file without realizing the source in /nix/store
+        # return None when this is not possible
+        source = get_git_source(self) if git_mirror_root else None
+        if source:
+            url, rev, _ = source
+            mirror = git_mirror.GitMirror(git_mirror_root, url)
+            # fetchgit: the mirror is faster than a new partial clone
+            # other fetchers: use the mirror only if it has the revision
+            if self.fetcher == "fetchgit" or mirror.has_rev(rev):
+                try:
+                    return decode_file_content(mirror.read_file(rev, filepath))
+                except subprocess.CalledProcessError as e:
+                    print(f"Repo.fetch_file: failed to read {filepath} from git mirror: {e}")
         try:
-            file_content = file_content.decode("utf8")
-        except UnicodeDecodeError:
-            pass
-        return file_content # str or bytes
+            url_decode = get_http_file_url(self, filepath)
+            if url_decode:
+                url, decode = url_decode
+                return decode(http_pool.get(url))
+            if self.fetcher == "fetchgit":
+                return git_get_file(self.args["url"], self.args["rev"], filepath)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Repo.fetch_file: failed to fetch {filepath}: {e}")
+        return None
 
-    def get_deps(self, repo_vars, path):
-        print("evaluating " + json.dumps(self, default = vars), file=sys.stderr)
+    def get_deps(self, repo_vars, path, pipeline=None):
+        self.get_platform_deps({ default_platform: repo_vars }, path, pipeline)
 
-        deps_file = self.get_file("DEPS")
-        evaluated = gclient_eval.Parse(deps_file, filename='DEPS')
+    def get_platform_deps(self, platform_vars, path, pipeline=None):
+        # platform_vars: platform name -> repo_vars
+        # every DEPS file is parsed once for all platforms
+        print("evaluating " + json.dumps(self, default = vars), file=sys.stderr)
 
-        repo_vars = dict(evaluated["vars"]) | repo_vars
+        if not self.platforms:
+            self.platforms = list(platform_vars)
 
-        prefix = f"{path}/" if (evaluated.get("use_relative_paths", False) and path != "") else ""
+        try:
+            deps_file = self.get_file("DEPS")
+        except PlanFileUnavailable as e:
+            # --plan: the deps of this source stay unknown
+            print(f"plan: not evaluating {path}: {e}")
+            plan_unevaluated_paths.append(path)
+            return
+        with trace.span("gclient_eval.Parse", path=path):
+            evaluated = gclient_eval.Parse(deps_file, filename='DEPS')
+
+        platform_vars = {
+            platform: dict(evaluated["vars"]) | repo_vars
+            for platform, repo_vars in platform_vars.items()
+        }
 
-        self.deps = {
-            prefix + dep_name: repo_from_dep(dep)
-            for dep_name, dep in evaluated["deps"].items()
-            if (gclient_eval.EvaluateCondition(dep["condition"], repo_vars) if "condition" in dep else True) and repo_from_dep(dep) != None
+        # for the memoized conditions. see condition.py
+        frozen_platform_vars = {
+            platform: condition.freeze(repo_vars)
+            for platform, repo_vars in platform_vars.items()
         }
 
-        for key in evaluated.get("recursedeps", []):
-            dep_path = prefix + key
-            if dep_path in self.deps and dep_path != "src/third_party/squirrel.mac":
-                self.deps[dep_path].get_deps(repo_vars, dep_path)
+        prefix = f"{path}/" if (evaluated.get("use_relative_paths", False) and path != "") else ""
+
+        self.deps = {}
+        for dep_name, dep in evaluated["deps"].items():
+            repo = repo_from_dep(dep)
+            if repo is None:
+                continue
+            if "condition" in dep:
+                repo.platforms = [
+                    platform
+                    for platform, frozen_vars in frozen_platform_vars.items()
+                    if evaluate_condition(dep["condition"], frozen_vars)
+                ]
+            else:
+                repo.platforms = list(platform_vars)
+            if repo.platforms:
+                self.deps[prefix + dep_name] = repo
+
+        # start hashing the deps now, while we parse the DEPS files of the recursedeps
+        if pipeline:
+            for dep_path, dep in self.deps.items():
+                pipeline.submit(dep, dep_path)
+
+        recursedeps = [
+            prefix + key
+            for key in evaluated.get("recursedeps", [])
+            if prefix + key in self.deps and prefix + key != "src/third_party/squirrel.mac"
+        ]
+
+        # fetch the DEPS files of this level in parallel
+        fetch_files([self.deps[dep_path] for dep_path in recursedeps], "DEPS")
+
+        for dep_path in recursedeps:
+            dep = self.deps[dep_path]
+            dep.get_platform_deps({ platform: platform_vars[platform] for platform in dep.platforms }, dep_path, pipeline)
 
 # whats the difference between nix-universal-prefetch and nix-build?
 # nix-universal-prefetch returns only the hash
@@ -144,13 +371,24 @@ class Repo:
 #     --rev de4ce0071eb47ed54cbda54869001210cf3a8ae5
 # sha256-5M7acPuJMkoNR+GNN2psMbrgx20c8fiIl3GXa7kP54Q=
 
-    def prefetch(self):
+    def prefetch(self, realize=True):
 
         # TODO remove "hash" and "sha256" values from the cache key
         # TODO rename cache_key to get_cache_key
         # TODO rename key to cache_key
         key = cache_key(self.flatten_repr())
 
+        # prefetch_all can run many prefetches in parallel
+        # the second caller of the same source waits for the first caller
+        # and then finds all values in the cache
+        with get_prefetch_lock(key):
+            with trace.span("prefetch", key=key):
+                self._prefetch(key, realize)
+
+    def _prefetch(self, key, realize):
+
+        load_cache_entry(key)
+
         # TODO use only "rev" as cache key (if rev is a git commit hash)
         # TODO lookup by revision. this is risky because sha1 hashes can collide (rarely)
 
@@ -166,12 +404,8 @@ class Repo:
             # note: we must rename outPath to __outPath, otherwise "nix eval" would reduce the src attribute-set to the outPath string
             #nix_expr = 'with import <nixpkgs> {}; let src = (' + nixpkgs_attr + '); in builtins.listToAttrs (map (x: { name = "_" + x.name; value = if builtins.isFunction x.value then "<function>" else x.value; }) (lib.attrsToList src))'
             #nix_expr = 'with import <nixpkgs> {}; let src = (' + nixpkgs_attr + ').overrideAttrs (attrs: { passthru = { inherit attrs; }; }); in builtins.listToAttrs (map (x: { name = "_" + x.name; value = if builtins.isFunction x.value then "<function>" else x.value; }) (lib.attrsToList src.attrs)) // { __outPath = src.outPath; }'
-            # hack: use overrideAttrs to get the arguments for derivation
-            nix_expr = 'with import <nixpkgs> {}; let src = (' + nixpkgs_attr + ').overrideAttrs (attrs: { passthru = { inherit attrs; }; }); in src.attrs // { __outPath = src.outPath; }'
-            cmd = [nix_bin, "eval", "--impure", "--json", "--expr", nix_expr]
-            print(shlex.join(cmd), file=sys.stderr)
-            out = subprocess.check_output(cmd)
-            src_attrs = json.loads(out.decode('utf-8'))
+            # one "nix eval" call for all pending nixpkgs attrs, see nix_eval.py
+            src_attrs = nix_evaluator.get_src_attrs(nixpkgs_attr)
 
             # remove "_" from keys
             #src_attrs = { key[1:]: val for key, val in src_attrs.items() }
@@ -198,8 +432,8 @@ class Repo:
             #    self.args["fetcher"] = "fetchurl"
 
             # copy attrs
-            for key in src_attrs:
-                self.args[key] = src_attrs[key]
+            for attr_name in src_attrs:
+                self.args[attr_name] = src_attrs[attr_name]
 
             #print(json.dumps(self.args, indent=2)); raise 123 # debug
 
@@ -214,6 +448,18 @@ class Repo:
 
         #raise Exception(f"prefetch: key = {key}")
 
+        # prefetch_time: duration of the fetch, for the estimates in schedule.py
+        fetch_start = time.monotonic()
+        fetched = not key in cache
+
+        if not key in cache and plan_mode:
+            raise PlanFileUnavailable(f"hashing the source needs a prefetch: {key}")
+
+        if not key in cache and native_hash_mode == "on":
+            hash = native_hash(self)
+            if hash:
+                cache[key] = hash
+
         if not key in cache:
             cmd = [nix_universal_prefetch_bin, self.fetcher]
             for arg_name, arg in self.args.items():
@@ -221,61 +467,126 @@ class Repo:
                 cmd.append(arg)
 
             print(shlex.join(cmd), file=sys.stderr)
-            out = subprocess.check_output(cmd)
+            with trace.span("nix-universal-prefetch"):
+                out = process_runner.check_output(cmd)
             cache[key] = out.decode('utf-8').strip()
 
-            # save this value to the temporary cache
-            key_hash = hashlib.sha256(key.encode("utf8")).hexdigest()
-            cache_file = temporary_cache_dir + "/" + key_hash
-            print(f"writing temporary cache file {cache_file}")
-            with open(cache_file, "w") as f:
-                # no, this is ugly, key is a json string
-                #json.dump({ "key": key, "value": cache[key] }, f)
-                f.write(key + "\n" + cache[key] + "\n")
-
             if key not in cache_extra_data:
                 cache_extra_data[key] = {}
 
+            # save the hash now. nix-build can take a long time
+            save_cache_entry(key)
+
+        journal_record("hash", key=key, hash=cache[key])
+
         if not key in cache_extra_data:
             cache_extra_data[key] = {}
 
-        if not "store_path" in cache_extra_data[key]:
-            print("getting store path")
-            nix_expr = f"with import <nixpkgs> {{}}; {self.fetcher} {{\n"
-            def str_nix_value(value):
-                # TODO detect boolean/integer/float/null/path values
-                return '"' + value.replace('"', '\\"') + '"'
-            for arg_name, arg in remove_hashes(self.args).items():
-                nix_expr += f"  {arg_name} = {str_nix_value(arg)};\n"
-            fetcher_hash_key = "hash" # some fetchers may require "sha256"
-            nix_expr += f"  {fetcher_hash_key} = {str_nix_value(cache[key])};\n"
-            nix_expr += "}"
-            cmd = [nix_build_bin, "-E", nix_expr]
-            #cmd += ["--no-out-link"] # no. this is risky because garbage collection. better: change workdir
-            print(shlex.join(cmd), file=sys.stderr)
-            tempdir = os.environ["HOME"] + "/.cache/gclient2nix"
-            os.makedirs(tempdir, exist_ok=True)
-            out = subprocess.check_output(cmd, cwd=tempdir)
-            store_path = out.decode('utf-8').strip()
-            print("store path:", store_path)
-            cache_extra_data[key]["store_path"] = store_path
-            cache_path = tempdir + "/" + os.path.basename(store_path)
-            os.rename(tempdir + "/result", cache_path)
-            print("cache path:", cache_path)
-
-            print("getting store path size")
-            cmd = ["du", "-sb", store_path]
-            out = subprocess.check_output(cmd)
-            store_path_size = int(out.decode('utf-8').strip().split("\t")[0])
-            print("store path size:", store_path_size)
-            cache_extra_data[key]["store_path_size"] = store_path_size
+        # hash-only mode: only the hash is needed for sources.json
+        # the store path is needed only to read files in Repo.get_file
+        # store_path_size is measured only for realized sources
+        if realize and not "store_path" in cache_extra_data[key]:
+            if plan_mode:
+                raise PlanFileUnavailable(f"realizing the source needs a nix-build: {key}")
+            self._realize(key)
+            fetched = True
+
+        # also a store path without size, for example after --resume,
+        # when the run was killed between the "store_path" and "size" records.
+        # measured after all prefetches, see measure_store_sizes
+        if "store_path" in cache_extra_data[key] and not "store_path_size" in cache_extra_data[key] and not plan_mode:
+            with unsized_keys_lock:
+                unsized_keys.add(key)
+
+        if fetched:
+            cache_extra_data[key]["prefetch_time"] = round(time.monotonic() - fetch_start, 3)
+
+        if native_hash_mode == "verify" and not plan_mode:
+            verify_native_hash(self, key)
+
+        save_cache_entry(key)
 
         self.hash = cache[key]
 
-    def prefetch_all(self):
-        self.prefetch()
+    def _realize(self, key):
+        print("getting store path")
+        self._add_from_git_mirror()
+        nix_expr = f"with import <nixpkgs> {{}}; {self.fetcher_expr(key)}"
+        tempdir = os.environ["HOME"] + "/.cache/gclient2nix"
+        os.makedirs(tempdir, exist_ok=True)
+        # parallel nix-build calls need different out-links
+        # otherwise they would all write to tempdir + "/result"
+        key_hash = hashlib.sha256(key.encode("utf8")).hexdigest()
+        out_link = tempdir + "/result-" + key_hash
+        cmd = [nix_build_bin, "-E", nix_expr, "--out-link", out_link]
+        #cmd += ["--no-out-link"] # no. this is risky because garbage collection. better: change workdir
+        print(shlex.join(cmd), file=sys.stderr)
+        with trace.span("nix-build"):
+            out = process_runner.check_output(cmd, cwd=tempdir)
+        store_path = out.decode('utf-8').strip()
+        self._set_store_path(key, store_path, out_link)
+
+    def fetcher_expr(self, key):
+        # nix expression of the fetcher call, with the known hash
+        nix_expr = f"{self.fetcher} {{\n"
+        def str_nix_value(value):
+            # TODO detect boolean/integer/float/null/path values
+            return '"' + value.replace('"', '\\"') + '"'
+        for arg_name, arg in remove_hashes(self.args).items():
+            nix_expr += f"  {arg_name} = {str_nix_value(arg)};\n"
+        fetcher_hash_key = "hash" # some fetchers may require "sha256"
+        nix_expr += f"  {fetcher_hash_key} = {str_nix_value(cache[key])};\n"
+        nix_expr += "}"
+        return nix_expr
+
+    def _add_from_git_mirror(self):
+        source = get_git_source(self) if git_mirror_root else None
+        if not source:
+            return
+        url, rev, remove_paths = source
+        mirror = git_mirror.GitMirror(git_mirror_root, url)
+        if mirror.has_rev(rev):
+            # add the source from the mirror to /nix/store
+            # when this has the same hash as the fetcher output
+            # then nix-build will not download the source again
+            try:
+                store_path = mirror.add_to_store(rev, remove_paths)
+                print(f"added source from git mirror: {store_path}")
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"failed to add source from git mirror: {e}")
+
+    def _set_store_path(self, key, store_path, out_link):
+        # out_link: gc root from nix-build, is moved to the cache dir
+        # in realize_batch, keys with the same fetcher expression share one out link,
+        # which was moved already for the first key
+        print("store path:", store_path)
+        cache_extra_data[key]["store_path"] = store_path
+        journal_record("store_path", key=key, store_path=store_path)
+        cache_path = os.path.dirname(out_link) + "/" + os.path.basename(store_path)
+        if os.path.lexists(out_link) or not os.path.lexists(cache_path):
+            os.replace(out_link, cache_path)
+        print("cache path:", cache_path)
+
+    def prefetch_all(self, jobs=1, realize=True):
+        if jobs <= 1:
+            self.prefetch(realize)
+            for [_, dep] in self.deps.items():
+                dep.prefetch_all(realize=realize)
+            return
+        # all prefetches are independent of each other
+        # so we can run them in parallel.
+        # this does not change the output,
+        # because flatten uses the order of self.deps
+        repos = list(self.iter_repos())
+        print(f"prefetching {len(repos)} sources with {jobs} jobs")
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # list: raise the first exception from the workers
+            list(executor.map(lambda repo: repo.prefetch(realize), repos))
+
+    def iter_repos(self):
+        yield self
         for [_, dep] in self.deps.items():
-            dep.prefetch_all()
+            yield from dep.iter_repos()
 
     def flatten_repr(self):
         return {
@@ -284,13 +595,552 @@ class Repo:
             **self.args
         }
 
-    def flatten(self, path):
-        out = {
-            path: self.flatten_repr()
+    def flatten(self, path, platform=None, annotate=False):
+        # dict: when a path is repeated in the tree
+        # then the first position and the last source are used
+        return dict(self.iter_flatten(path, platform, annotate))
+
+    def iter_flatten(self, path, platform=None, annotate=False):
+        # yield (path, source) in depth-first order
+        # platform: only the sources of this platform
+        # annotate: add the platforms of every source as "__platforms"
+        # repeated paths are yielded repeatedly. see iter_output
+        for path, repo in self.iter_tree(path, platform):
+            yield path, repo.source_repr(annotate)
+
+    def iter_output(self, path, platform=None, annotate=False):
+        # yield the items of flatten, without building the dict
+        # a path can be repeated in the tree, when two DEPS files have a dep at the same path.
+        # then the output has the path at its first position, with the source of its last position,
+        # same as flatten (dict keeps the first key and the last value).
+        # the first pass finds the last repo of every repeated path,
+        # so only the repeated paths are kept in memory
+        seen = set()
+        last_repos = {}
+        for item_path, repo in self.iter_tree(path, platform):
+            if item_path in seen:
+                last_repos[item_path] = repo
+            seen.add(item_path)
+        seen = set()
+        for item_path, repo in self.iter_tree(path, platform):
+            if item_path in seen:
+                continue
+            seen.add(item_path)
+            yield item_path, last_repos.get(item_path, repo).source_repr(annotate)
+
+    def iter_tree(self, path, platform=None):
+        # yield (path, repo) in depth-first order
+        # no recursion: deep trees of recursedeps
+        stack = [(path, self)]
+        while stack:
+            path, repo = stack.pop()
+            if platform is not None and not platform in repo.platforms:
+                continue
+            yield path, repo
+            stack.extend(reversed(repo.deps.items()))
+
+    def source_repr(self, annotate=False):
+        source = self.flatten_repr()
+        if annotate:
+            source["__platforms"] = self.platforms
+        return source
+
+def realize_batch(repos, jobs=1):
+    # realize many sources with one nix-build call
+    # one nix evaluation: nixpkgs is imported only once, not once per source
+    # repos: prefetched repos without store_path. only the first repo per cache key is built
+    pending = {}
+    for repo in repos:
+        key = cache_key(repo.flatten_repr())
+        load_cache_entry(key)
+        if not "store_path" in cache_extra_data.get(key, {}) and not key in pending:
+            pending[key] = repo
+    if not pending:
+        return
+    print(f"building {len(pending)} sources with one nix-build call")
+    for repo in pending.values():
+        repo._add_from_git_mirror()
+    # attribute names: hash of the fetcher expression
+    # nix-build prints the store paths in the sorted order of attribute names,
+    # but only once per derivation. keys with the same fetcher expression
+    # have the same derivation, so they share one attribute
+    attrs = {}
+    exprs = {}
+    for key, repo in pending.items():
+        fetcher_expr = repo.fetcher_expr(key)
+        attr_name = "s" + hashlib.sha256(fetcher_expr.encode("utf8")).hexdigest()
+        attrs.setdefault(attr_name, []).append(key)
+        exprs[attr_name] = fetcher_expr
+    nix_expr = "with import <nixpkgs> {}; {\n"
+    for attr_name in sorted(attrs):
+        nix_expr += f"{attr_name} = " + exprs[attr_name].replace("\n", "\n  ") + ";\n"
+    nix_expr += "}\n"
+    tempdir = os.environ["HOME"] + "/.cache/gclient2nix"
+    os.makedirs(tempdir, exist_ok=True)
+    # the expression can be larger than the maximum size of a command line argument
+    expr_hash = hashlib.sha256(nix_expr.encode("utf8")).hexdigest()
+    expr_file = tempdir + "/batch-" + expr_hash + ".nix"
+    with open(expr_file, "w") as f:
+        f.write(nix_expr)
+    out_link = tempdir + "/result-batch-" + expr_hash
+    # keep-going: build all other sources when one source fails
+    cmd = [nix_build_bin, expr_file, "--keep-going", "--max-jobs", str(max(1, jobs)), "--out-link", out_link]
+    print(shlex.join(cmd), file=sys.stderr)
+    try:
+        with trace.span("nix-build batch", count=len(pending)):
+            returncode, stdout, _ = process_runner.run(cmd, cwd=tempdir)
+    finally:
+        os.unlink(expr_file)
+    # out links of multiple results: result, result-2, result-3, ...
+    out_links = {
+        attr_name: out_link if idx == 0 else f"{out_link}-{idx + 1}"
+        for idx, attr_name in enumerate(sorted(attrs))
+    }
+    store_paths = {}
+    if returncode == 0:
+        # the store path of an attribute is the target of its out link.
+        # the order of stdout is only used to check the out links
+        stdout_paths = stdout.decode("utf8").split()
+        for idx, attr_name in enumerate(sorted(attrs)):
+            try:
+                store_path = os.readlink(out_links[attr_name])
+            except OSError:
+                break
+            if idx >= len(stdout_paths) or stdout_paths[idx] != store_path:
+                break
+            store_paths[attr_name] = store_path
+    if len(store_paths) != len(attrs):
+        # some builds failed, or the out links dont match the attributes.
+        # realize the sources one by one, to get the errors.
+        # the successful builds are in /nix/store now, so they are fast
+        print(f"nix-build failed for some sources, realizing {len(pending)} sources one by one")
+        for link in out_links.values():
+            if os.path.islink(link):
+                os.unlink(link)
+        for key, repo in pending.items():
+            with get_prefetch_lock(key):
+                repo._prefetch(key, realize=True)
+        return
+    for attr_name in sorted(attrs):
+        for key in attrs[attr_name]:
+            with get_prefetch_lock(key):
+                pending[key]._set_store_path(key, store_paths[attr_name], out_links[attr_name])
+                save_cache_entry(key)
+            with unsized_keys_lock:
+                unsized_keys.add(key)
+
+def measure_store_sizes():
+    # store_path_size of all realized sources without a size,
+    # with one "nix path-info" call (see store_size.py)
+    with unsized_keys_lock:
+        keys = sorted(unsized_keys)
+        unsized_keys.clear()
+    store_paths = {}
+    for key in keys:
+        store_path = cache_extra_data.get(key, {}).get("store_path")
+        # nixpkgs_attr: the store path is known before it is built
+        if store_path and os.path.exists(store_path):
+            store_paths[key] = store_path
+    if not store_paths:
+        return
+    print(f"measuring {len(store_paths)} store paths")
+    with trace.span("store size", count=len(store_paths)):
+        sizes = store_size_provider.get_sizes(list(store_paths.values()))
+    for key, store_path in store_paths.items():
+        with get_prefetch_lock(key):
+            cache_extra_data[key]["store_path_size"] = sizes[store_path]
+            cache_extra_data[key]["store_path_size_unit"] = "nar"
+            journal_record("size", key=key, size=sizes[store_path], unit="nar")
+            save_cache_entry(key)
+
+def load_size_estimator():
+    # sizes of all sources in the cache, see schedule.py
+    estimator = SizeEstimator()
+    if cache_db is not None:
+        for url, size, prefetch_time in cache_db.get_store_path_sizes():
+            estimator.add(url, size, prefetch_time)
+    return estimator
+
+def estimate_prefetch_size(repo, realize, estimator):
+    # estimated number of bytes to fetch in Repo.prefetch. 0: all values are cached
+    key = cache_key(repo.flatten_repr())
+    load_cache_entry(key)
+    forget_missing_store_path(key)
+    extra_data = cache_extra_data.get(key, {})
+    has_hash = key in cache or "hash" in repo.args or "sha256" in repo.args
+    if has_hash and (not realize or "store_path" in extra_data):
+        return 0
+    if "store_path_size" in extra_data:
+        return extra_data["store_path_size"]
+    if repo.fetcher == "fetchFromGitHub":
+        url = f"https://github.com/{repo.args['owner']}/{repo.args['repo']}"
+    else:
+        url = repo.args.get("url")
+    return estimator.estimate(normalize_url(url) if isinstance(url, str) else None)
+
+class PrefetchPipeline:
+    # run Repo.prefetch in worker threads
+    # while the main thread is still parsing DEPS files.
+    # when get_deps reaches a recursedep which is being prefetched,
+    # then Repo.get_file waits for that prefetch (see get_prefetch_lock)
+    # the largest pending source is prefetched first, see schedule.py
+    def __init__(self, jobs, realize=True, partial_output=None):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.realize = realize
+        # PartialOutput: every source is written as soon as its hash is known
+        self.partial_output = partial_output
+        self.futures = []
+        # number of sources copied from the previous output
+        self.reused = 0
+        # interned sources: cache key -> (repo, path)
+        # the same source at multiple paths is prefetched only once
+        self.interned = {}
+        # (repo, path, interned repo)
+        self.duplicates = []
+        # (start, end) times of all prefetch calls
+        self.intervals = []
+        self.intervals_lock = threading.Lock()
+        # pending sources: heap of (-estimated size, number, repo, path)
+        self.queue = []
+        self.queue_lock = threading.Lock()
+        self.size_estimator = load_size_estimator()
+        self.progress = PrefetchProgress()
+
+    def submit(self, repo, path=None):
+        if path is not None and reuse_previous_output(repo, path):
+            self.reused += 1
+            self.add_partial_output(repo, path)
+            return
+        key = cache_key(repo.flatten_repr())
+        if key in self.interned:
+            self.duplicates.append((repo, path, self.interned[key][0]))
+            return
+        self.interned[key] = (repo, path)
+        size = estimate_prefetch_size(repo, self.realize, self.size_estimator)
+        self.progress.add(size)
+        with self.queue_lock:
+            heapq.heappush(self.queue, (-size, len(self.interned), repo, path))
+        # every task takes the largest source from the queue
+        self.futures.append(self.executor.submit(self.prefetch_next))
+
+    def prefetch_next(self):
+        with self.queue_lock:
+            neg_size, _, repo, path = heapq.heappop(self.queue)
+        self.progress.started()
+        self.prefetch(repo, path)
+        self.progress.done(-neg_size)
+
+    def prefetch(self, repo, path=None):
+        start = time.monotonic()
+        try:
+            repo.prefetch(self.realize)
+        finally:
+            end = time.monotonic()
+            with self.intervals_lock:
+                self.intervals.append((start, end))
+        self.add_partial_output(repo, path)
+
+    def add_partial_output(self, repo, path):
+        if self.partial_output and path is not None:
+            self.partial_output.add(path, repo.flatten_repr())
+
+    def wait(self):
+        try:
+            for future in self.futures:
+                # raise the first exception from the workers
+                future.result()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+        for repo, path, interned_repo in self.duplicates:
+            repo.hash = interned_repo.hash
+            self.add_partial_output(repo, path)
+
+    def busy_time(self, since=0):
+        # wall-clock time when at least one prefetch was running
+        # this is the duration of a separate prefetch phase with the same number of jobs
+        busy = 0
+        busy_end = since
+        for start, end in sorted(self.intervals):
+            start = max(start, busy_end)
+            if end > start:
+                busy += end - start
+                busy_end = end
+        return busy
+
+def resolve_deps(main_repo, platform_vars, path, jobs=1, realize=True, partial_output=None, batch_build=False):
+    # parse DEPS files and prefetch sources at the same time
+    # this replaces main_repo.get_deps(...) followed by main_repo.prefetch_all()
+    # platform_vars: platform name -> repo_vars. sources of all platforms are prefetched once
+    # realize=False: get only the hashes. Repo.get_file realizes sources on demand
+    # batch_build: get the hashes first, then realize all sources with one nix-build call
+    pipeline = PrefetchPipeline(jobs, realize and not batch_build, partial_output)
+    start = time.monotonic()
+    try:
+        pipeline.submit(main_repo, path)
+        main_repo.get_platform_deps(platform_vars, path, pipeline)
+        discovery_end = time.monotonic()
+        pipeline.wait()
+    except BaseException:
+        pipeline.executor.shutdown(wait=False, cancel_futures=True)
+        # first fatal error: kill the running tools
+        process_runner.cancel()
+        raise
+    if realize and batch_build:
+        realize_batch([repo for repo, _ in pipeline.interned.values()], jobs)
+    measure_store_sizes()
+    end = time.monotonic()
+    discovery_time = discovery_end - start
+    total_time = end - start
+    # without the pipeline, all prefetches would start after the DEPS parsing
+    sequential_time = discovery_time + pipeline.busy_time(start)
+    print(f"resolved {len(pipeline.futures)} sources in {total_time:.1f} seconds")
+    if pipeline.reused > 0:
+        print(f"copied {pipeline.reused} unchanged sources from the previous output")
+    if pipeline.duplicates:
+        sizes = [get_source_size(interned_repo.flatten_repr()) for _, _, interned_repo in pipeline.duplicates]
+        size_str = f"{sum(size for size in sizes if size is not None)} bytes"
+        unknown = sum(1 for size in sizes if size is None)
+        if unknown > 0:
+            size_str += f" + {unknown} of unknown size"
+        print(f"deduplicated {len(pipeline.duplicates)} sources at multiple paths ({size_str})")
+    print(f"parsing DEPS files took {discovery_time:.1f} seconds")
+    print(f"pipelining saved {max(0, sequential_time - total_time):.1f} seconds (estimated {sequential_time:.1f} seconds without pipelining)")
+
+def plan_deps(main_repo, platform_vars, path, jobs=1, realize=True):
+    # --plan: parse DEPS files with cached or lightweight file reads (see Repo.fetch_file)
+    # and return what a run would fetch, without calling nix-universal-prefetch or nix-build
+    main_repo.get_platform_deps(platform_vars, path)
+    estimator = load_size_estimator()
+    sources = {}
+    seen_keys = set()
+    # (repo, path, depth). main repo has depth 1
+    stack = [(main_repo, path, 1)]
+    while stack:
+        repo, repo_path, depth = stack.pop()
+        key = cache_key(repo.flatten_repr())
+        load_cache_entry(key)
+        # a missing store path is not cached, it needs a nix-build
+        forget_missing_store_path(key)
+        extra_data = cache_extra_data.get(key, {})
+        size = 0
+        if key in seen_keys:
+            status = "duplicate"
+        elif reuse_previous_output(repo, repo_path):
+            status = "previous output"
+        else:
+            size = estimate_prefetch_size(repo, realize, estimator)
+            if key in cache and "store_path" in extra_data:
+                status = "cached store path"
+            elif key in cache or "hash" in repo.args or "sha256" in repo.args:
+                status = "cached hash"
+            else:
+                status = "needs fetch"
+        seen_keys.add(key)
+        sources[repo_path] = {
+            "status": status,
+            "estimated_bytes": size,
+            "depth": depth,
+            "platforms": repo.platforms,
         }
-        for dep_path, dep in self.deps.items():
-            out |= dep.flatten(dep_path)
-        return out
+        if repo_path in plan_unevaluated_paths:
+            sources[repo_path]["unevaluated"] = True
+        # reversed: same order as flatten
+        for dep_path, dep in reversed(repo.deps.items()):
+            stack.append((dep, dep_path, depth + 1))
+    sizes = [source["estimated_bytes"] for source in sources.values()]
+    status_counts = {}
+    for source in sources.values():
+        status_counts[source["status"]] = status_counts.get(source["status"], 0) + 1
+    return {
+        "sources": sources,
+        "summary": {
+            "sources": len(sources),
+            "status": status_counts,
+            "estimated_bytes": sum(sizes),
+            "estimated_seconds": round(estimate_duration(sizes, jobs, estimator.rate()), 1),
+            "jobs": jobs,
+            "depth": max(source["depth"] for source in sources.values()),
+            "unevaluated": list(plan_unevaluated_paths),
+        },
+    }
+
+def print_plan(plan):
+    for source_path, source in plan["sources"].items():
+        note = " (deps unknown)" if source.get("unevaluated") else ""
+        print(f"{source['status']:<18}  {format_size(source['estimated_bytes']):>10}  {source_path}{note}")
+    summary = plan["summary"]
+    print(f"{summary['sources']} sources:", ", ".join(f"{count} {status}" for status, count in summary["status"].items()))
+    print(f"dependency graph depth: {summary['depth']}")
+    print(f"estimated download: {format_size(summary['estimated_bytes'])}")
+    print(f"estimated duration: {format_duration(summary['estimated_seconds'])} with {summary['jobs']} jobs")
+    if summary["unevaluated"]:
+        print(f"{len(summary['unevaluated'])} DEPS files need a prefetch, so their deps are not in the plan")
+
+# platforms, see --platform-matrix
+# example: "linux", "android", "linux-arm64"
+platform_os_names = ["ios", "chromeos", "android", "mac", "win", "linux"]
+platform_cpu_names = ["x86", "x64", "arm", "arm64", "mips", "mips64", "ppc", "s390", "riscv64"]
+default_platform = "linux"
+
+def get_platform_vars(platform):
+    # return the builtin variables of gclient for a platform
+    # without cpu: only checkout_{os}, like old versions of gclient2nix
+    platform_os, _, platform_cpu = platform.partition("-")
+    if not platform_os in platform_os_names:
+        raise ValueError(f"unknown platform os {platform_os!r} in {platform!r}. known: {', '.join(platform_os_names)}")
+    if platform_cpu and not platform_cpu in platform_cpu_names:
+        raise ValueError(f"unknown platform cpu {platform_cpu!r} in {platform!r}. known: {', '.join(platform_cpu_names)}")
+    repo_vars = {
+        f"checkout_{name}": name == platform_os
+        for name in platform_os_names
+    }
+    if platform_cpu:
+        repo_vars |= {
+            f"checkout_{name}": name == platform_cpu
+            for name in platform_cpu_names
+        }
+    return repo_vars
+
+# sources.json from a previous run, see --previous-output
+# path -> source
+previous_output = {}
+
+def reuse_previous_output(repo, path):
+    # copy the hash from the previous output, if the source did not change
+    # return True if the source needs no prefetch
+    previous = previous_output.get(path)
+    if previous is None or not "hash" in previous:
+        return False
+    key = cache_key(repo.flatten_repr())
+    if cache_key(previous) != key:
+        return False
+    repo.hash = previous["hash"]
+    if not key in cache:
+        cache[key] = previous["hash"]
+    return True
+
+class PartialOutput:
+    # progress of a run, in JSON Lines format
+    # sources.json is written at the end, in the order of the tree.
+    # until then, every source is appended to this file as soon as its hash is known,
+    # so the progress is visible, and a crashed run leaves its results
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+
+    def add(self, path, source):
+        line = json.dumps({ "path": path, "source": source }, default = vars)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self, remove=False):
+        with self.lock:
+            self.file.close()
+        if remove:
+            os.unlink(self.path)
+
+def write_output_file(output_file, items, json_lines=False):
+    # atomic: readers see the old file or the complete new file
+    # also after a crash: the data is on disk before the rename,
+    # and the rename is on disk before we return
+    temp_file = output_file + ".tmp"
+    with open(temp_file, "w") as f:
+        if json_lines:
+            for path, source in items:
+                f.write(json.dumps({ "path": path, "source": source }, default = vars) + "\n")
+        else:
+            write_sources(f, items)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, output_file)
+    dir_fd = os.open(os.path.dirname(output_file) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def read_output_file(output_file):
+    # return a dict: path -> source
+    # the output file can be in JSON Lines format, see --json-lines
+    with open(output_file) as f:
+        text = f.read()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    tree = {}
+    for line in text.splitlines():
+        if line.strip():
+            item = json.loads(line)
+            tree[item["path"]] = item["source"]
+    return tree
+
+def write_sources(f, items):
+    # write (path, source) items as a json object
+    # same format as json.dumps(tree, indent=2), but one source at a time
+    f.write("{")
+    separator = "\n"
+    for path, source in items:
+        source_str = json.dumps(source, indent=2, default = vars).replace("\n", "\n  ")
+        f.write(f"{separator}  {json.dumps(path)}: {source_str}")
+        separator = ",\n"
+    f.write("\n}\n" if separator != "\n" else "}\n")
+
+def add_aliases(items):
+    # replace repeated sources with { "__alias": path of the first source }
+    # items: (path, source)
+    first_paths = {}
+    for path, source in items:
+        key = cache_key({ attr: source[attr] for attr in source if attr != "__platforms" })
+        if key in first_paths:
+            alias = { "__alias": first_paths[key] }
+            if "__platforms" in source:
+                alias["__platforms"] = source["__platforms"]
+            yield path, alias
+        else:
+            first_paths[key] = path
+            yield path, source
+
+def resolve_aliases(tree):
+    # reverse of add_aliases
+    return {
+        path: tree[source["__alias"]] if "__alias" in source else source
+        for path, source in tree.items()
+    }
+
+def get_source_size(source):
+    # return the recorded store_path_size of a source, or None
+    key = cache_key(source)
+    load_cache_entry(key)
+    return cache_extra_data.get(key, {}).get("store_path_size")
+
+def print_change_summary(previous_tree, tree):
+    changes = { "added": [], "changed": [], "removed": [] }
+    unchanged = 0
+    for path, source in tree.items():
+        if not path in previous_tree:
+            changes["added"].append((path, source))
+        elif cache_key(previous_tree[path]) != cache_key(source) or previous_tree[path].get("hash") != source.get("hash"):
+            changes["changed"].append((path, source))
+        else:
+            unchanged += 1
+    for path, source in previous_tree.items():
+        if not path in tree:
+            changes["removed"].append((path, source))
+    for change, sources in changes.items():
+        for path, source in sources:
+            print(f"{change}: {path}")
+    print("changes:")
+    for change, sources in changes.items():
+        sizes = [get_source_size(source) for _, source in sources]
+        size_str = f"{sum(size for size in sizes if size is not None)} bytes"
+        unknown = sum(1 for size in sizes if size is None)
+        if unknown > 0:
+            size_str += f" + {unknown} of unknown size"
+        print(f"  {change}: {len(sources)} sources, {size_str}")
+    print(f"  unchanged: {unchanged} sources")
 
 class GitRepo(Repo):
     def __init__(self, url, rev):
@@ -305,9 +1155,6 @@ class GitRepo(Repo):
             "rev": rev,
         }
 
-    #def get_file(self, filepath):
-    #    TODO try sparse checkout
-
 class GitHubRepo(Repo):
     def __init__(self, owner, repo, rev):
         super().__init__()
@@ -318,10 +1165,6 @@ class GitHubRepo(Repo):
             "rev": rev,
         }
 
-    def get_file(self, filepath):
-        # TODO prefer prefetched file in /nix/store
-        return urlopen(f"https://raw.githubusercontent.com/{self.args['owner']}/{self.args['repo']}/{self.args['rev']}/{filepath}").read().decode('utf-8')
-
 class GitilesRepo(Repo):
     def __init__(self, url, rev):
         super().__init__()
@@ -365,32 +1208,249 @@ class GitilesRepo(Repo):
             self.args['postFetch'] += "rm -r $out/extensions/test/data; "
             self.args['postFetch'] += "rm -r $out/media/test/data; "
 
-    def get_file(self, filepath):
-        # TODO prefer prefetched file in /nix/store
-        return base64.b64decode(urlopen(f"{self.args['url']}/+/{self.args['rev']}/{filepath}?format=TEXT").read()).decode('utf-8')
+def get_git_source(repo):
+    # return (url, rev, remove_paths) for nar.git_source_hash and git_mirror.py
+    # or None if the fetcher arguments are not supported
+    args = remove_hashes(repo.args)
+    if repo.fetcher == "fetchFromGitHub":
+        url = f"https://github.com/{args.pop('owner', '')}/{args.pop('repo', '')}"
+    elif repo.fetcher in ("fetchFromGitiles", "fetchgit"):
+        url = args.pop("url", None)
+    else:
+        return None
+    rev = args.pop("rev", None)
+    if not url or not rev or not gclient_utils.IsFullGitSha(rev):
+        return None
+    post_fetch = args.pop("postFetch", "")
+    if args:
+        # for example fetchSubmodules, sparseCheckout
+        return None
+    try:
+        remove_paths = nar.parse_post_fetch(post_fetch)
+    except nar.NativeHashUnsupported:
+        return None
+    return url, rev, remove_paths
+
+def native_hash(repo):
+    # return the hash, or None if the source is not supported
+    source = get_git_source(repo)
+    if source is None:
+        return None
+    print(f"native hash: {source[0]} {source[1]}")
+    if git_mirror_root:
+        function, args = git_mirror.mirror_source_hash, (git_mirror_root, *source)
+    else:
+        function, args = nar.git_source_hash, source
+    if native_hash_executor is None:
+        return function(*args)
+    return native_hash_executor.submit(function, *args).result()
+
+def verify_native_hash(repo, key):
+    if key in native_hash_verified:
+        return
+    native_hash_verified.add(key)
+    if cache_extra_data[key].get("native_hash") in ("match", "unsupported"):
+        # verified in an earlier run
+        return
+    try:
+        hash = native_hash(repo)
+    except (OSError, subprocess.CalledProcessError) as e:
+        # for example no network. verified again in the next run
+        print(f"native hash failed: {key}: {e}")
+        native_hash_stats["failed"] += 1
+        return
+    if hash is None:
+        result = "unsupported"
+    elif hash == cache[key]:
+        result = "match"
+    else:
+        result = "mismatch"
+        print(f"native hash mismatch: {key}: expected {cache[key]}, got {hash}")
+    native_hash_stats[result] += 1
+    cache_extra_data[key]["native_hash"] = result
+
+def decode_file_content(file_content):
+    try:
+        return file_content.decode("utf8")
+    except UnicodeDecodeError:
+        return file_content # bytes
+
+def get_cached_source_file(key, filepath):
+    if cache_db is None:
+        return None
+    file_content = cache_db.get_source_file(key, filepath)
+    if file_content is None:
+        return None
+    return decode_file_content(file_content)
+
+def put_cached_source_file(key, filepath, file_content):
+    if cache_db is None:
+        return
+    if isinstance(file_content, str):
+        file_content = file_content.encode("utf8")
+    cache_db.put_source_file(key, filepath, file_content)
+
+def read_store_file(store_path, filepath):
+    # TODO directory vs archive -> extract only needed files or zipmount
+    if not os.path.exists(store_path):
+        raise Exception(f"missing store_path {store_path}")
+    if os.path.isdir(store_path):
+        with open(store_path + "/" + filepath) as f:
+            return f.read()
+    if cache_db is not None:
+        return read_indexed_archive_file(store_path, filepath)
+    # note: this hangs: bsdtar -t -f chromium-124.0.6367.60.tar.zstd | head -n1
+    # get top-level folder, usually "source/"
+    # TODO top-level folder can be missing, for example in 7zip source
+    # $ tar tf /nix/store/anc9r9znhghg3x112r1vcra5k0x7dk1z-chromium-124.0.6367.60.tar.zstd | head -n1
+    # source/
+    cmd = ["tar", "-t", "-f", store_path]
+    print(shlex.join(cmd) + " | head -n1", file=sys.stderr)
+    toplevel_path = process_runner.check_output(cmd, first_line=True).decode("utf8").strip()
+    print("toplevel_path", repr(toplevel_path))
+    if toplevel_path[-1] != "/":
+        # first file in archive is not a directory
+        # -> assume there is not toplevel dir
+        toplevel_path = ""
+    # "bsdtar --fast-read" is 1000x faster than "tar"
+    # if the extracted file is at the beginning of the archive
+    # https://unix.stackexchange.com/questions/61461/how-to-extract-specific-files-from-tar-gz
+    # https://unix.stackexchange.com/a/775952/295986
+    # $ bsdtar --fast-read -x -f chromium-124.0.6367.60.tar.zstd -- source/DEPS
+    cmd = ["bsdtar", "--fast-read", "-x", "-f", store_path, "--to-stdout", "--", toplevel_path + filepath]
+    print(shlex.join(cmd), file=sys.stderr)
+    file_content = process_runner.check_output(cmd)
+    print("file_content:", repr(file_content[0:100]) + "...")
+    return decode_file_content(file_content)
+
+def read_indexed_archive_file(store_path, filepath):
+    # read a file from an archive with the member index, see archive_index.py
+    # the first call scans the whole archive, later calls need no decompression
+    # for the indexed files like DEPS or package-lock.json
+    with get_prefetch_lock("archive:" + store_path):
+        if not cache_db.is_archive_indexed(store_path):
+            print(f"indexing archive {store_path}")
+            with trace.span("index archive"):
+                count = cache_db.put_archive_index(store_path, archive_index.scan_archive(store_path))
+            print(f"indexed {count} archive members")
+    toplevel_path = cache_db.get_archive_toplevel_path(store_path)
+    member_name = toplevel_path + filepath
+    member = cache_db.get_archive_member(store_path, member_name)
+    if member is None:
+        raise FileNotFoundError(f"no such file in archive {store_path}: {member_name}")
+    size, file_content = member
+    if file_content is None:
+        # not indexed. extract once, then store it in the index
+        cmd = ["bsdtar", "--fast-read", "-x", "-f", store_path, "--to-stdout", "--", member_name]
+        print(shlex.join(cmd), file=sys.stderr)
+        with trace.span("bsdtar"):
+            file_content = process_runner.check_output(cmd)
+        if size <= archive_index.max_indexed_file_size:
+            cache_db.put_archive_member_content(store_path, member_name, file_content)
+    return decode_file_content(file_content)
+
+def gitiles_file_url(url, rev, filepath):
+    return f"{url}/+/{rev}/{filepath}?format=TEXT"
+
+def decode_gitiles_file(body):
+    return base64.b64decode(body).decode('utf-8')
+
+def gitiles_get_file(url, rev, filepath):
+    return decode_gitiles_file(http_pool.get(gitiles_file_url(url, rev, filepath)))
+
+def github_file_url(owner, repo, rev, filepath):
+    return f"https://raw.githubusercontent.com/{owner}/{repo}/{rev}/{filepath}"
+
+def decode_github_file(body):
+    return body.decode('utf-8')
+
+def github_get_file(owner, repo, rev, filepath):
+    return decode_github_file(http_pool.get(github_file_url(owner, repo, rev, filepath)))
+
+def get_http_file_url(repo, filepath):
+    # return (url, decode) or None
+    if repo.fetcher == "fetchFromGitiles":
+        return gitiles_file_url(repo.args["url"], repo.args["rev"], filepath), decode_gitiles_file
+    if repo.fetcher == "fetchFromGitHub":
+        return github_file_url(repo.args["owner"], repo.args["repo"], repo.args["rev"], filepath), decode_github_file
+    return None
+
+def fetch_files(repos, filepath):
+    # fetch one file of many repos in parallel with http_pool.get_many
+    # for example the DEPS files of all recursedeps of one level
+    # the following Repo.get_file calls take the files from fetched_files
+    requests = {}
+    for repo in repos:
+        key = cache_key(repo.flatten_repr())
+        if (key, filepath) in journal_files or (key, filepath) in fetched_files or (key, filepath) in requests:
+            continue
+        if cache_db is not None and cache_db.get_source_file(key, filepath) is not None:
+            continue
+        load_cache_entry(key)
+        if cache_extra_data.get(key, {}).get("store_path"):
+            continue
+        if git_mirror_root and get_git_source(repo):
+            # Repo.fetch_file prefers the git mirror
+            continue
+        url_decode = get_http_file_url(repo, filepath)
+        if url_decode:
+            requests[(key, filepath)] = url_decode
+    if len(requests) < 2:
+        return
+    with trace.span("fetch_files", path=filepath, count=len(requests)):
+        results = http_pool.get_many([url for url, _ in requests.values()])
+    for ((key, filepath), (url, decode)), result in zip(requests.items(), results):
+        if isinstance(result, Exception):
+            # Repo.get_file will try again
+            print(f"fetch_files: failed to fetch {url}: {result}")
+            continue
+        fetched_files[(key, filepath)] = decode(result)
+
+def git_get_file(url, rev, filepath):
+    # shallow partial clone: fetch only the commit object.
+    # git cat-file then fetches only the trees and the blob of this file
+    # this needs a git server with support for partial clone and fetch by commit hash
+    with tempfile.TemporaryDirectory(prefix="gclient2nix-git-") as git_dir:
+        def git(*args):
+            cmd = ["git", "-C", git_dir, *args]
+            print(shlex.join(cmd), file=sys.stderr)
+            return process_runner.check_output(cmd)
+        git("init", "--quiet", "--bare")
+        git("remote", "add", "origin", url)
+        git("fetch", "--quiet", "--depth=1", "--filter=tree:0", "--no-tags", "origin", rev)
+        return decode_file_content(git("cat-file", "blob", f"{rev}:{filepath}"))
 
 def get_yarn_hash(repo, yarn_lock_path = 'yarn.lock'):
     # TODO use yarn2nix for granular caching
     key = "yarn-"+cache_key(repo.flatten_repr())
+    load_cache_entry(key)
     if not key in cache:
         print(f'prefetch-yarn-deps', file=sys.stderr)
         with tempfile.TemporaryDirectory() as tmp_dir:
             with open(tmp_dir + '/yarn.lock', 'w') as f:
                 f.write(repo.get_file(yarn_lock_path))
-            cache[key] = subprocess.check_output(['prefetch-yarn-deps', tmp_dir + '/yarn.lock']).decode('utf-8').strip()
+            cache[key] = process_runner.check_output(['prefetch-yarn-deps', tmp_dir + '/yarn.lock']).decode('utf-8').strip()
+        save_cache_entry(key)
     return cache[key]
 
 def get_npm_hash(repo, package_lock_path = 'package-lock.json'):
     # TODO use npmlock2nix for granular caching
     key = "npm-"+cache_key(repo.flatten_repr())
+    load_cache_entry(key)
     if not key in cache:
         print(f'prefetch-npm-deps', file=sys.stderr)
         with tempfile.TemporaryDirectory() as tmp_dir:
             with open(tmp_dir + '/package-lock.json', 'w') as f:
                 f.write(repo.get_file(package_lock_path))
-            cache[key] = subprocess.check_output(['prefetch-npm-deps', tmp_dir + '/package-lock.json']).decode('utf-8').strip()
+            cache[key] = process_runner.check_output(['prefetch-npm-deps', tmp_dir + '/package-lock.json']).decode('utf-8').strip()
+        save_cache_entry(key)
     return cache[key]
 
+def evaluate_condition(dep_condition, frozen_vars):
+    # same as gclient_eval.EvaluateCondition, but compiled and memoized
+    with trace.span("EvaluateCondition"):
+        return condition.evaluate(dep_condition, frozen_vars)
+
 def repo_from_dep(dep):
     if "url" in dep:
         url, rev = gclient_utils.SplitUrlRevision(dep["url"])
@@ -410,7 +1470,7 @@ def repo_from_dep(dep):
 def get_gn_source(repo):
     gn_pattern = r"'gn_version': 'git_revision:([0-9a-f]{40})'"
     gn_commit = re.search(gn_pattern, repo.get_file("DEPS")).group(1)
-    gn = subprocess.check_output([
+    gn = process_runner.check_output([
         "nix-prefetch-git",
         "--quiet",
         "https://gn.googlesource.com/gn",
@@ -453,8 +1513,56 @@ def parse_args():
     # args.use_relative_paths
     parser.add_argument('--use-relative-paths', help='example: "true", default: use value of "use_relative_paths" from DEPS file')
 
+    # args.previous_output
+    parser.add_argument('--previous-output', help='copy unchanged sources from a previous output file, and print the changes. example: "sources.json"')
+
     # args.cache_dir
-    parser.add_argument('--cache-dir')
+    parser.add_argument('--cache-dir', help='directory of the persistent cache. default: ~/.cache/gclient2nix')
+
+    # args.import_cache
+    parser.add_argument('--import-cache', action="append", default=[], help='import a cache.txt file from an old version of gclient2nix into the persistent cache. example: docs/examples/pdfium/cache.txt')
+
+    # args.export_cache
+    parser.add_argument('--export-cache', help='write the persistent cache to a file in the old cache.txt format')
+
+    # args.hash_only
+    parser.add_argument('--hash-only', action='store_true', help='get only the hashes of sources, without building them in /nix/store. sources are built only when files are read from them. store_path_size is recorded only for built sources. note: without --native-hash, nix-universal-prefetch still downloads every source to /nix/store')
+
+    # args.native_hash
+    parser.add_argument('--native-hash', choices=["off", "on", "verify"], default="verify", help='compute hashes of git sources without nix-universal-prefetch. "verify": get the hashes from nix-universal-prefetch, and compare them once per source with native hashes. "on": use native hashes in sources.json. "on" is not validated against nix yet, check "native hash: ... mismatch" in the output of "verify" first. default: "verify"')
+
+    # args.git_mirror
+    parser.add_argument('--git-mirror', action='store_true', help='keep local git mirrors in ~/.cache/gclient2nix/git for native hashing, file reads and realizing sources. see also: python -m gclient2nix.git_mirror report')
+
+    # args.platform_matrix
+    parser.add_argument('--platform-matrix', help='resolve the sources for multiple platforms in one run. platform: os or os-cpu. when the output file contains "{platform}" then write one file per platform, otherwise write one file with "__platforms" for every source. example: "linux,android,chromeos,linux-arm64", default: "linux"')
+
+    # args.resume
+    parser.add_argument('--resume', action='store_true', help='continue a crashed run with the same output file. the finished steps are read from the journal file "{output file}.journal"')
+
+    # args.json_lines
+    parser.add_argument('--json-lines', action='store_true', help='write the output file in JSON Lines format: one line {"path": ..., "source": {...}} per source. for very large trees')
+
+    # args.aliases
+    parser.add_argument('--aliases', action='store_true', help='write repeated sources (same fetcher arguments at multiple paths) as {"__alias": "path/of/first/source"}')
+
+    # args.batch_build
+    parser.add_argument('--batch-build', action='store_true', help='get all hashes first, then build all sources with one nix-build call (nix-build --keep-going --max-jobs JOBS), so nixpkgs is evaluated only once')
+
+    # args.nix_eval_jobs
+    parser.add_argument('--nix-eval-jobs', type=int, default=1, help='number of parallel "nix eval" calls for nixpkgs_attr sources. every call evaluates all pending attributes. default: 1')
+
+    # args.trace
+    parser.add_argument('--trace', help='write the timing of all phases to a file in the chrome trace_event format, and print a summary table. example: "trace.json"')
+
+    # args.jobs
+    parser.add_argument('--http-connections', type=int, default=4, help='maximum number of parallel http requests per host, for gitiles and github files. default: 4')
+    parser.add_argument('--http-timeout', type=float, default=60, help='timeout of http requests in seconds. default: 60')
+    parser.add_argument('--max-processes', type=int, help='maximum number of parallel external tools like nix-build or git. default: same as --jobs')
+    parser.add_argument('--tool-jobs', action='append', default=[], metavar='TOOL=N', help='maximum number of parallel processes of one tool. example: "nix-build=2". can be used multiple times')
+    parser.add_argument('--plan', action='store_true', help='dry run: parse DEPS files, and print the status, estimated download size and duration of all sources. does not call nix-universal-prefetch or nix-build for uncached sources, and writes no output file')
+    parser.add_argument('--plan-json', metavar='FILE', help='with --plan: also write the plan as JSON to FILE. "-" for stdout')
+    parser.add_argument('--jobs', '-j', type=int, default=gclient_utils.NumLocalCpus(), help='number of parallel prefetch jobs. example: "1" to prefetch sources one by one, default: number of cpus')
 
     args = parser.parse_args()
 
@@ -470,72 +1578,108 @@ def parse_args():
 
     return args
 
-# persistent cache. ideally use a separate database process to avoid data loss, and to avoid too many disk writes
-# compromise solution: use a fixed tempdir path in tmpfs (/run/user/1000/gclient2nix-temp-cache) as a temporary cache
+# persistent cache: sqlite database in persistent_cache_dir, see cache_db.py
+# every entry is written right after Repo.prefetch,
+# so there is no data loss when the program crashes,
+# and multiple gclient2nix processes can use the same cache
+#
+# old versions of gclient2nix used a text file (cache.txt) as persistent cache
+# and a fixed tempdir path in tmpfs (/run/user/1000/gclient2nix-temp-cache) as a temporary cache
 # 1000 == os.getuid()
-# when the program is finished, add the temporary cache to a persistent cache on disk
-# when the program crashes, on the next run, restore the temporary cache
-# the temporary cache allows multiple writers and readers
-# by storing each entry in a separate file
-# tmpfs: see also: https://pypi.org/project/memory-tempfile/
+# both are imported into the sqlite database on startup
 
 persistent_cache_dir = os.environ["HOME"] + "/.cache/gclient2nix"
 
 temporary_cache_dir = f"/run/user/{os.getuid()}/gclient2nix-temp-cache"
 
-def main():
-    global cache
+def load_persistent_cache(args):
+    global cache_db
+    global persistent_cache_dir
+
+    if args.cache_dir:
+        persistent_cache_dir = args.cache_dir
+
+    os.makedirs(persistent_cache_dir, exist_ok=True)
+
+    global git_mirror_root
+    if args.git_mirror:
+        git_mirror_root = persistent_cache_dir + "/git"
+
+    persistent_cache_db_file = persistent_cache_dir + "/cache.sqlite"
+    print(f"using persistent cache {persistent_cache_db_file}")
+    cache_db = CacheDatabase(persistent_cache_db_file)
 
+    # import the persistent cache of old versions
+    text_cache_files = list(args.import_cache)
+    legacy_cache_file = persistent_cache_dir + "/cache.txt"
+    if os.path.exists(legacy_cache_file) and not cache_db.is_imported(legacy_cache_file):
+        text_cache_files.append(legacy_cache_file)
+    for text_cache_file in text_cache_files:
+        count = cache_db.import_text_cache(text_cache_file)
+        print(f"imported {count} cache entries from {text_cache_file}")
+
+    # import the temporary cache of old versions
+    # when a previous run did not save the persistent cache
+    # then there are values in the temporary cache
+    if os.path.isdir(temporary_cache_dir):
+        for filename in os.listdir(temporary_cache_dir):
+            # sha256 hexdigest has 64 chars
+            if len(filename) != 64:
+                continue
+            cache_file_path = temporary_cache_dir + "/" + filename
+            print(f"importing temporary cache file {cache_file_path}")
+            with open(cache_file_path) as f:
+                text = f.read()
+                parts = text.split("\n")
+                key = parts[0].strip()
+                value = parts[1].strip()
+            cache_db.put(key, value, {})
+            os.unlink(cache_file_path)
+
+def main():
     args = parse_args()
 
+    global plan_mode
+    plan_mode = args.plan
+    plan_stdout = sys.stdout
+    if args.plan and args.plan_json == "-":
+        # stdout is only for the JSON plan. all other output goes to stderr
+        sys.stdout = sys.stderr
+
+    if args.trace:
+        trace.enable()
+        # also write the trace when gclient2nix fails, to see where the time went
+        atexit.register(write_trace, args.trace)
+
     # def get_deps(self, repo_vars, path):
     #electron_repo.get_deps({
     #    f"checkout_{platform}": platform == "linux"
     #    for platform in ["ios", "chromeos", "android", "mac", "win", "linux"]
     #}, "src/electron")
 
-    os.makedirs(persistent_cache_dir, exist_ok=True)
-    os.makedirs(temporary_cache_dir, exist_ok=True)
-
-    # load the persistent cache
-    persistent_cache_file = persistent_cache_dir + "/cache.txt"
-    if os.path.exists(persistent_cache_file):
-        print(f"loading persistent cache from {persistent_cache_file}")
-        with open(persistent_cache_file) as f:
-            #cache = json.load(f)
-            text = f.read()
-            for block in text.split("\n\n\n\n"):
-                #print("block", repr(block))
-                block_parts = block.split("\n")
-                key = block_parts[0]
-                value = json.loads(block_parts[1])
-                # block can have 3 parts because of "\n" at end of file
-                cache[key] = value["hash"]
-                cache_extra_data[key] = value
-                del cache_extra_data[key]["hash"]
-
-    # load the temporary cache
-    # when a previous run did not save the persistent cache
-    # then there are values in the temporary cache
-    for filename in os.listdir(temporary_cache_dir):
-        # sha256 hexdigest has 64 chars
-        if len(filename) != 64:
-            continue
-        cache_file_path = temporary_cache_dir + "/" + filename
-        print(f"loading temporary cache file {cache_file_path}")
-        with open(cache_file_path) as f:
-            text = f.read()
-            parts = text.split("\n")
-            key = parts[0].strip()
-            value = parts[1].strip()
-            cache[key] = value
-            print(f"loaded cache key: {repr(key)}")
-            print(f"loaded cache value: {repr(value)}")
-
-    repo_vars = {
-        f"checkout_{platform}": platform == "linux"
-        for platform in ["ios", "chromeos", "android", "mac", "win", "linux"]
-    }
+    load_persistent_cache(args)
+
+    nix_evaluator.pool_size = max(1, args.nix_eval_jobs)
+    http_pool.max_connections_per_host = max(1, args.http_connections)
+    http_pool.timeout = args.http_timeout
+    process_runner.max_processes = max(1, args.max_processes or args.jobs)
+    for tool_jobs in args.tool_jobs:
+        tool, _, tool_limit = tool_jobs.rpartition("=")
+        if not tool or not tool_limit.isdigit():
+            raise Exception(f"invalid --tool-jobs value {tool_jobs!r}. example: nix-build=2")
+        process_runner.tool_limits[tool] = int(tool_limit)
+
+    global native_hash_mode
+    global native_hash_executor
+    native_hash_mode = args.native_hash
+    if native_hash_mode != "off":
+        # a mistake in nar.py would give wrong hashes. see nar.self_check
+        nar.self_check()
+        # hashing is cpu-bound, so we use processes
+        # fork: the workers need no import of gclient2nix
+        native_hash_executor = ProcessPoolExecutor(max_workers=max(1, args.jobs), mp_context=multiprocessing.get_context("fork"))
+        # start the workers now, before we start threads
+        native_hash_executor.submit(int).result()
 
     # parse args.main_source_args
     main_source_args = {}
@@ -567,64 +1711,122 @@ def main():
     # FIXME repo.recurse is not handled
     #main_repo.recurse = True
 
-    # fetch the main repo, so we have the DEPS file
-    print("fetching the main source")
-    main_repo.prefetch()
+    # the DEPS file of the main repo is fetched by get_deps
+    # nixpkgs_attr: prefetch replaces the arguments of the main repo
+    if "nixpkgs_attr" in main_repo.args:
+        print("fetching the main source")
+        try:
+            # --plan: only evaluate the nixpkgs attr, dont build it
+            main_repo.prefetch(realize=not args.plan)
+        except PlanFileUnavailable as e:
+            print(f"plan: not fetching the main source: {e}")
+
+    global previous_output
+    if args.previous_output:
+        print(f"loading previous output file: {args.previous_output}")
+        previous_output = {
+            path: { attr: source[attr] for attr in source if attr != "__platforms" }
+            for path, source in resolve_aliases(read_output_file(args.previous_output)).items()
+        }
 
-    print("parsing sources of dependencies")
+    print("parsing and fetching sources of dependencies")
     print("args.main_source_path:", repr(args.main_source_path))
-    repo_vars = {
-      f"checkout_{platform}": platform == "linux"
-      for platform in ["ios", "chromeos", "android", "mac", "win", "linux"]
+    platforms = args.platform_matrix.split(",") if args.platform_matrix else [default_platform]
+    platform_vars = {
+        platform: get_platform_vars(platform)
+        for platform in platforms
     }
-    main_repo.get_deps(repo_vars, args.main_source_path)
+    if args.plan:
+        plan = plan_deps(main_repo, platform_vars, args.main_source_path, args.jobs, realize=not args.hash_only)
+        print_plan(plan)
+        if args.plan_json == "-":
+            json.dump(plan, plan_stdout, indent=2)
+            plan_stdout.write("\n")
+        elif args.plan_json:
+            print(f"writing plan file: {args.plan_json}")
+            with open(args.plan_json, "w") as f:
+                json.dump(plan, f, indent=2)
+                f.write("\n")
+        finish(args)
+        return
+
+    global journal
+    journal = Journal(args.output_file.replace("{platform}", "all") + ".journal")
+    if args.resume:
+        counts = replay_journal()
+        print(f"resuming from {journal.path}:", ", ".join(f"{count} {step}" for step, count in counts.items()) or "empty")
+    journal.open(resume=args.resume)
+
+    partial_output_file = args.output_file.replace("{platform}", "all") + ".partial"
+    print(f"writing progress to {partial_output_file}")
+    partial_output = PartialOutput(partial_output_file)
+    resolve_deps(main_repo, platform_vars, args.main_source_path, args.jobs, realize=not args.hash_only, partial_output=partial_output, batch_build=args.batch_build)
+
+    if args.previous_output:
+        print_change_summary(previous_output, main_repo.flatten(args.main_source_path))
+
+    if args.platform_matrix:
+        for platform in platforms:
+            print(f"platform {platform}: {sum(1 for _ in main_repo.iter_output(args.main_source_path, platform))} sources")
+
+    # output_files: output file -> (platform, annotate)
+    # the sources are streamed to the output files, see Repo.iter_output
+    if not args.platform_matrix:
+        output_files = { args.output_file: (None, False) }
+    elif "{platform}" in args.output_file:
+        output_files = {
+            args.output_file.replace("{platform}", platform): (platform, False)
+            for platform in platforms
+        }
+    else:
+        output_files = { args.output_file: (None, True) }
 
-    print("fetching sources of dependencies")
-    main_repo.prefetch_all()
+    for output_file, (platform, annotate) in output_files.items():
+        items = main_repo.iter_output(args.main_source_path, platform, annotate)
+        if args.aliases:
+            items = add_aliases(items)
+        print(f"writing output file: {output_file}")
+        with trace.span("write output"):
+            write_output_file(output_file, items, args.json_lines)
 
-    tree = main_repo.flatten(args.main_source_path)
+    partial_output.close(remove=True)
 
-    print(f"writing output file: {args.output_file}")
-    with open(args.output_file, "w") as f:
-        f.write(json.dumps(tree, indent=2, default = vars) + "\n")
+    # the run is complete, so there is nothing to resume
+    journal.close(remove=True)
 
-    # TODO load the persistent cache again
-    # to add cached values from other gclient2nix processes
+    # the persistent cache was written by Repo.prefetch
 
-    # TODO load the temporary cache again
-    # to add cached values from other gclient2nix processes
+    finish(args)
 
-    # save the persistent cache
-    print(f"writing persistent cache to {persistent_cache_file}")
-    with open(persistent_cache_file, "w") as f:
-        def get_cache_entry_str(key):
-            cache_value = {
-                "hash": cache[key],
-                **cache_extra_data.get(key, {}),
-            }
-            return key + "\n" + json.dumps(cache_value)
-        f.write("\n\n\n\n".join(map(get_cache_entry_str, cache.keys())) + "\n")
+def finish(args):
+    nix_evaluator.stop()
+    http_pool.close()
+    process_runner.stop()
 
-    # delete known values from the temporary cache
-    # which have been saved in the persistent cache
-    for key in cache:
-        key_hash = hashlib.sha256(key.encode("utf8")).hexdigest()
-        cache_file = temporary_cache_dir + "/" + key_hash
-        if os.path.exists(cache_file):
-            os.unlink(cache_file)
+    if native_hash_executor:
+        native_hash_executor.shutdown()
+        print("native hash:", ", ".join(f"{count} {name}" for name, count in native_hash_stats.items()))
+
+    if args.export_cache:
+        count = cache_db.export_text_cache(args.export_cache)
+        print(f"exported {count} cache entries to {args.export_cache}")
+
+    cache_db.close()
+
+def write_trace(trace_file):
+    print(f"writing trace file: {trace_file}")
+    trace.write(trace_file)
+    trace.print_summary()
 
 # __name__ src.gclient2nix.gclient2nix
 #print("__name__", __name__)
 
-if __name__ == '__main__':
-    main()
+# python -m gclient2nix: main is called in __main__.py
+# note: dont call main on import of this module.
+# native hashing (nar.py) uses worker processes,
+# and forked workers would deadlock on the import lock of this module
 
-# let me call: python -m src.gclient2nix
-if __name__ == 'src.gclient2nix.gclient2nix':
-    main()
-
-# let me call: python -m gclient2nix
-if __name__ == 'gclient2nix.gclient2nix':
+if __name__ == '__main__':
     main()
 
 # TODO nix build retry loop?
@@ -639,58 +1841,57 @@ if __name__ == 'gclient2nix.gclient2nix':
 # TODO keep a persistent list of "large subtrees"
 # so we can optimize "git clone" operations
 
-sys.exit()
-
 
 
 # orignal main code block for electron
+# not used
 
-try:
-    with open('info.json', 'r') as f:
-        old_info = json.loads(f.read())
-        for [_, version] in old_info.items():
-            for [dep_path, dep] in version["deps"].items():
-                cache[cache_key(dep)] = dep["hash"]
-            cache["npm-"+cache_key(version["deps"]["src"])] = version["chromium_npm_hash"]
-            cache["yarn-"+cache_key(version["deps"]["src/electron"])] = version["electron_yarn_hash"]
-except:
-    print("not using cache: ", file=sys.stderr)
-    traceback.print_exc()
-
-out = {}
-
-electron_releases = json.loads(urlopen("https://releases.electronjs.org/releases.json").read())
-
-for major_version in range(26, 21, -1):
-    major_version_releases = filter(lambda item: item["version"].startswith(f"{major_version}."), electron_releases)
-    m = max(major_version_releases, key=lambda item: item["date"])
-
-    rev=f"v{m['version']}"
-
-    electron_repo = GitHubRepo("electron", "electron", rev)
-    # FIXME repo.recurse is not handled?
-    electron_repo.recurse = True
-
-    electron_repo.get_deps({
-        f"checkout_{platform}": platform == "linux"
-        for platform in ["ios", "chromeos", "android", "mac", "win", "linux"]
-    }, "src/electron")
-
-    electron_repo.prefetch_all()
-
-    tree = electron_repo.flatten("src/electron")
-
-    out[f"{major_version}"] = {
-      "electron_yarn_hash": get_yarn_hash(electron_repo),
-      "chromium_npm_hash": get_npm_hash(electron_repo.deps["src"], "third_party/node/package-lock.json"),
-      "deps": tree,
-      **{key: m[key] for key in ["version", "modules", "chrome"]},
-      "chromium": {
-          "version": m['chrome'],
-          "deps": get_gn_source(electron_repo.deps["src"])
-      }
-    }
+def main_electron():
+
+    try:
+        with open('info.json', 'r') as f:
+            old_info = json.loads(f.read())
+            for [_, version] in old_info.items():
+                for [dep_path, dep] in version["deps"].items():
+                    cache[cache_key(dep)] = dep["hash"]
+                cache["npm-"+cache_key(version["deps"]["src"])] = version["chromium_npm_hash"]
+                cache["yarn-"+cache_key(version["deps"]["src/electron"])] = version["electron_yarn_hash"]
+    except:
+        print("not using cache: ", file=sys.stderr)
+        traceback.print_exc()
+
+    out = {}
+
+    electron_releases = json.loads(urlopen("https://releases.electronjs.org/releases.json").read())
+
+    for major_version in range(26, 21, -1):
+        major_version_releases = filter(lambda item: item["version"].startswith(f"{major_version}."), electron_releases)
+        m = max(major_version_releases, key=lambda item: item["date"])
+
+        rev=f"v{m['version']}"
+
+        electron_repo = GitHubRepo("electron", "electron", rev)
+        # FIXME repo.recurse is not handled?
+        electron_repo.recurse = True
+
+        electron_repo.get_deps(get_platform_vars(default_platform), "src/electron")
+
+        electron_repo.prefetch_all()
+        measure_store_sizes()
+
+        tree = electron_repo.flatten("src/electron")
+
+        out[f"{major_version}"] = {
+          "electron_yarn_hash": get_yarn_hash(electron_repo),
+          "chromium_npm_hash": get_npm_hash(electron_repo.deps["src"], "third_party/node/package-lock.json"),
+          "deps": tree,
+          **{key: m[key] for key in ["version", "modules", "chrome"]},
+          "chromium": {
+              "version": m['chrome'],
+              "deps": get_gn_source(electron_repo.deps["src"])
+          }
+        }
 
-with open('info.json', 'w') as f:
-    f.write(json.dumps(out, indent=4, default = vars))
-    f.write('\n')
+    with open('info.json', 'w') as f:
+        f.write(json.dumps(out, indent=4, default = vars))
+        f.write('\n')
@@ -0,0 +1,239 @@
+# local git mirrors
+#
+# one bare git repo per url in ~/.cache/gclient2nix/git
+# similar to "git cache" in depot_tools (git_cache.py)
+#
+# a new version of chromium or electron changes the revisions of most deps,
+# but the trees of the new revisions share most objects with the old revisions.
+# "git fetch" into an existing mirror downloads only the missing objects
+#
+# the mirrors are used for
+# - native hashing (nar.py)
+# - reading files like DEPS (Repo.get_file)
+# - realizing sources in /nix/store without downloading them again (Repo._realize)
+#
+# every fetched revision gets a ref refs/gclient2nix/<rev>
+# so "git gc" does not remove its objects
+#
+# usage:
+#   python -m gclient2nix.git_mirror report
+#   python -m gclient2nix.git_mirror prune
+
+import argparse
+import fcntl
+import os
+import re
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import nar
+from .cache_db import normalize_url
+
+# store paths of fixed-output derivations depend only on name and hash
+# so "nix-store --add-fixed" gives the same store path as the fetcher
+nix_store_bin = "nix-store"
+
+last_used_file = "gclient2nix-last-used"
+
+# ProcessRunner, see process_runner.py. set by gclient2nix
+# None: use subprocess, for "python -m gclient2nix.git_mirror"
+runner = None
+
+def check_output(cmd, quiet=False):
+    if runner:
+        return runner.check_output(cmd, quiet=quiet)
+    return subprocess.check_output(cmd, stderr=subprocess.DEVNULL if quiet else None)
+
+def default_mirror_root():
+    return os.environ["HOME"] + "/.cache/gclient2nix/git"
+
+def mirror_name(url):
+    # example: https://chromium.googlesource.com/chromium/src.git
+    # -> chromium.googlesource.com-chromium-src
+    url = normalize_url(url)
+    url = re.sub(r"^[a-z+]+://", "", url)
+    return re.sub(r"[^a-zA-Z0-9._]+", "-", url).strip("-")
+
+class GitMirror:
+    def __init__(self, mirror_root, url):
+        self.url = normalize_url(url)
+        self.path = mirror_root + "/" + mirror_name(url)
+        self.lock_path = self.path + ".lock"
+
+    def git(self, *args, check=True, quiet=False):
+        cmd = ["git", "-C", self.path, *args]
+        if not quiet:
+            print(shlex.join(cmd), file=sys.stderr)
+        if check:
+            return check_output(cmd)
+        try:
+            check_output(cmd, quiet=True)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def lock(self):
+        # one writer per mirror, also across gclient2nix processes
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        lock_file = open(self.lock_path, "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def has_rev(self, rev):
+        if not os.path.isdir(self.path):
+            return False
+        return self.git("cat-file", "-e", f"{rev}^{{commit}}", check=False, quiet=True)
+
+    def ensure_rev(self, rev):
+        # fetch the revision, if it is missing in the mirror
+        with self.lock():
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+                self.git("init", "--quiet", "--bare")
+                self.git("config", "remote.origin.url", self.url)
+                self.git("config", "gc.auto", "0")
+            if not self.has_rev(rev):
+                # depth=1: we need only the tree of this revision
+                # objects which are already in the mirror are not downloaded again
+                self.git("fetch", "--quiet", "--depth=1", "--no-tags", "origin", rev)
+                self.git("update-ref", f"refs/gclient2nix/{rev}", rev)
+            with open(self.path + "/" + last_used_file, "w") as f:
+                f.write(str(int(time.time())) + "\n")
+
+    def read_file(self, rev, filepath):
+        self.ensure_rev(rev)
+        return self.git("cat-file", "blob", f"{rev}:{filepath}")
+
+    def hash(self, rev, remove_paths=()):
+        self.ensure_rev(rev)
+        return nar.nar_hash_git_tree(self.path, rev, remove_paths)
+
+    def checkout(self, rev, dest, remove_paths=()):
+        # write the tree of the revision to dest, without .git
+        self.ensure_rev(rev)
+        os.makedirs(dest)
+        # git archive: no index file, so this can run in parallel
+        # the archive is a temporary file, not a pipe, so both processes run in the runner
+        archive_file = dest + ".tar"
+        self.git("archive", "--format=tar", "--output", archive_file, rev)
+        try:
+            cmd = ["tar", "-x", "-f", archive_file, "-C", dest]
+            print(shlex.join(cmd), file=sys.stderr)
+            check_output(cmd)
+        finally:
+            os.unlink(archive_file)
+        for remove_path, force in remove_paths:
+            remove_path = dest + "/" + remove_path
+            if os.path.isdir(remove_path) and not os.path.islink(remove_path):
+                shutil.rmtree(remove_path)
+            elif os.path.lexists(remove_path):
+                os.unlink(remove_path)
+            elif not force:
+                # like "rm -r" in postFetch
+                raise FileNotFoundError(f"postFetch removes a missing path: {remove_path}")
+
+    def add_to_store(self, rev, remove_paths=()):
+        # return the store path
+        # the name of the store path is "source", like in fetchgit and fetchFromGitiles
+        with tempfile.TemporaryDirectory(prefix="gclient2nix-checkout-") as tempdir:
+            dest = tempdir + "/source"
+            self.checkout(rev, dest, remove_paths)
+            cmd = [nix_store_bin, "--add-fixed", "--recursive", "sha256", dest]
+            print(shlex.join(cmd), file=sys.stderr)
+            return check_output(cmd).decode("utf8").strip()
+
+def mirror_source_hash(mirror_root, url, rev, remove_paths=()):
+    # like nar.git_source_hash, but with a mirror
+    # this runs in a worker process, see gclient2nix.native_hash
+    try:
+        return GitMirror(mirror_root, url).hash(rev, remove_paths)
+    except nar.NativeHashUnsupported as e:
+        print(f"native hash: {url} {rev}: {e}", file=sys.stderr)
+        return None
+
+def get_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(dirpath + "/" + filename).st_size
+    return size
+
+def list_mirrors(mirror_root):
+    # yield (url, path)
+    if not os.path.isdir(mirror_root):
+        return
+    for name in sorted(os.listdir(mirror_root)):
+        path = mirror_root + "/" + name
+        if not os.path.isdir(path):
+            continue
+        try:
+            url = subprocess.check_output(["git", "-C", path, "config", "remote.origin.url"]).decode("utf8").strip()
+        except subprocess.CalledProcessError:
+            url = None
+        yield url, path
+
+def referenced_urls(cache_db_file, sources_files):
+    # urls of all git sources in the cache database and in sources.json files
+    urls = set()
+    if os.path.exists(cache_db_file):
+        connection = sqlite3.connect(cache_db_file)
+        for (url,) in connection.execute("SELECT DISTINCT url FROM cache WHERE url IS NOT NULL"):
+            urls.add(normalize_url(url))
+        connection.close()
+    # gclient2nix imports this module, so import it here
+    from .gclient2nix import read_output_file, resolve_aliases
+    for sources_file in sources_files:
+        # the file can be in JSON Lines format, and repeated sources can be aliases
+        for source in resolve_aliases(read_output_file(sources_file)).values():
+            if "url" in source:
+                urls.add(normalize_url(source["url"]))
+            elif "owner" in source and "repo" in source:
+                urls.add(f"https://github.com/{source['owner']}/{source['repo']}")
+    return urls
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def main():
+    parser = argparse.ArgumentParser(prog='gclient2nix.git_mirror')
+    parser.add_argument('command', choices=["report", "prune"])
+    parser.add_argument('--mirror-dir', default=default_mirror_root(), help='default: ~/.cache/gclient2nix/git')
+    parser.add_argument('--cache-db', default=os.environ["HOME"] + "/.cache/gclient2nix/cache.sqlite", help='mirrors of urls in this cache database are referenced. default: ~/.cache/gclient2nix/cache.sqlite')
+    parser.add_argument('--sources', action="append", default=[], help='mirrors of urls in this sources.json file are referenced')
+    parser.add_argument('--dry-run', action='store_true', help='prune: only print the unreferenced mirrors')
+    args = parser.parse_args()
+
+    if args.command == "report":
+        total_size = 0
+        for url, path in list_mirrors(args.mirror_dir):
+            size = get_size(path)
+            total_size += size
+            print(f"{format_size(size):>10}  {url}")
+        print(f"{format_size(total_size):>10}  total")
+        return
+
+    urls = referenced_urls(args.cache_db, args.sources)
+    pruned_size = 0
+    for url, path in list_mirrors(args.mirror_dir):
+        if url is not None and normalize_url(url) in urls:
+            continue
+        size = get_size(path)
+        pruned_size += size
+        print(f"pruning {format_size(size)}  {url or path}")
+        if not args.dry_run:
+            shutil.rmtree(path)
+            if os.path.exists(path + ".lock"):
+                os.unlink(path + ".lock")
+    print(f"pruned {format_size(pruned_size)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# shared http client for file reads from gitiles and github
+#
+# - keep-alive connections, pooled per host
+# - bounded number of parallel requests per host
+# - timeouts
+# - retries with exponential backoff on 429 and 5xx responses and on connection errors
+# - get_many: fetch many urls in parallel, for example all DEPS files of one recursion level
+#
+# the responses are not cached here:
+# files of immutable revisions are cached by (url, rev, path) in the cache database,
+# see Repo.get_file and cache_db.py
+#
+# url_rewrites: for tests and benchmarks with a local http server. example:
+#   http_client.url_rewrites.append(("https://", "http://127.0.0.1:8000/"))
+
+import http.client
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from . import trace
+
+class HttpError(OSError):
+    def __init__(self, url, status, reason=""):
+        super().__init__(f"HTTP {status}{' ' + reason if reason else ''}: {url}")
+        self.url = url
+        self.status = status
+
+class HostPool:
+    # idle keep-alive connections to one host
+    def __init__(self, scheme, netloc, max_connections, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # return (connection, reused)
+        self.semaphore.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout), False
+
+    def release(self, connection, reuse):
+        if reuse:
+            with self.lock:
+                self.idle.append(connection)
+        else:
+            connection.close()
+        self.semaphore.release()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+class HttpClient:
+    def __init__(self, max_connections_per_host=4, timeout=60, retries=4, backoff=1.0, max_redirects=5):
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.retries = retries
+        # seconds before the first retry. doubled for every retry
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        self.url_rewrites = []
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.request_count = 0
+
+    def rewrite_url(self, url):
+        for prefix, replacement in self.url_rewrites:
+            if url.startswith(prefix):
+                return replacement + url[len(prefix):]
+        return url
+
+    def get_pool(self, scheme, netloc):
+        with self.pools_lock:
+            if not (scheme, netloc) in self.pools:
+                self.pools[(scheme, netloc)] = HostPool(scheme, netloc, self.max_connections_per_host, self.timeout)
+            return self.pools[(scheme, netloc)]
+
+    def get(self, url):
+        # return the response body as bytes
+        # raise HttpError for other responses than 200
+        request_url = self.rewrite_url(url)
+        for _ in range(self.max_redirects + 1):
+            with trace.span("http get", url=url):
+                status, headers, body = self.request(request_url)
+            if status in (301, 302, 303, 307, 308) and headers.get("Location"):
+                request_url = urllib.parse.urljoin(request_url, headers["Location"])
+                continue
+            if status != 200:
+                raise HttpError(url, status)
+            return body
+        raise HttpError(url, status, "too many redirects")
+
+    def request(self, url):
+        # return (status, headers, body)
+        parts = urllib.parse.urlsplit(url)
+        if not parts.scheme in ("http", "https"):
+            raise ValueError(f"unsupported url: {url}")
+        pool = self.get_pool(parts.scheme, parts.netloc)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        attempt = 0
+        while True:
+            connection, reused = pool.acquire()
+            self.request_count += 1
+            try:
+                connection.request("GET", path, headers={ "User-Agent": "gclient2nix" })
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                pool.release(connection, reuse=False)
+                if reused and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    # the server closed the idle keep-alive connection. this is no failed attempt
+                    continue
+                if attempt >= self.retries:
+                    raise
+                retry_after = None
+            else:
+                pool.release(connection, reuse=not response.will_close)
+                if response.status != 429 and response.status < 500:
+                    return response.status, response.headers, body
+                if attempt >= self.retries:
+                    return response.status, response.headers, body
+                retry_after = response.headers.get("Retry-After")
+            delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            print(f"http_client: retry {attempt + 1} of {self.retries} in {delay:.1f} seconds: {url}")
+            time.sleep(delay)
+            attempt += 1
+
+    def get_many(self, urls, jobs=None):
+        # fetch urls in parallel
+        # return a list of bytes or exceptions, in the order of urls
+        # the number of parallel requests per host is limited by the pool of the host
+        urls = list(urls)
+        if not urls:
+            return []
+        def get_or_error(url):
+            try:
+                return self.get(url)
+            except (OSError, http.client.HTTPException) as e:
+                return e
+        with ThreadPoolExecutor(max_workers=jobs or min(len(urls), 32)) as executor:
+            return list(executor.map(get_or_error, urls))
+
+    def close(self):
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.close()
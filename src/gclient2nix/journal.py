@@ -0,0 +1,82 @@
+# progress journal, see --resume
+#
+# every completed step of a run is appended to the journal (JSON Lines):
+#   {"step": "file", "key": ..., "path": "DEPS", "content": ...}  DEPS file read
+#     binary files have "encoding": "base64"
+#   {"step": "hash", "key": ..., "hash": ...}                     hash computed
+#   {"step": "store_path", "key": ..., "store_path": ...}         source realized
+#   {"step": "size", "key": ..., "size": ..., "unit": "nar"}      store path size measured
+#
+# after a crash, "gclient2nix --resume" replays the journal,
+# so the finished steps are not repeated, and the run continues with the first unfinished step
+#
+# fsync is expensive, so the journal is synced in batches:
+# after batch_size records, or batch_interval seconds after the last sync.
+# a process crash loses nothing (every record is flushed),
+# a system crash loses at most one batch
+
+import json
+import os
+import threading
+import time
+
+class Journal:
+    def __init__(self, path, batch_size=100, batch_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def open(self, resume=False):
+        # resume=False: start a new journal
+        incomplete = False
+        if resume and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                incomplete = f.read(1) != b"\n"
+        self.file = open(self.path, "a" if resume else "w")
+        if incomplete:
+            # terminate the incomplete last line of the crashed run
+            self.file.write("\n")
+
+    def replay(self):
+        # yield the records of the journal
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a crashed run can be incomplete
+                    continue
+                yield record
+
+    def record(self, step, **data):
+        line = json.dumps({ "step": step, **data })
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.batch_size or time.monotonic() - self.last_sync >= self.batch_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self, remove=False):
+        with self.lock:
+            if self.file is None:
+                return
+            self._sync()
+            self.file.close()
+            self.file = None
+        if remove:
+            os.unlink(self.path)
@@ -0,0 +1,342 @@
+# native NAR hashing
+#
+# compute the hash of a fetcher output without nix-universal-prefetch
+# nix-universal-prefetch evaluates nixpkgs and builds the fetcher derivation
+# which costs some seconds per source, before the download even starts
+#
+# here we fetch the git revision with git, and serialize the tree of the revision
+# directly from the git objects into the NAR format, so there is no checkout on disk
+# the sha256 hash of the NAR is the "hash" value of the fetcher
+#
+# NAR format: see "Nix Archive" in the nix manual
+# and figure 5.2 in https://edolstra.github.io/pubs/phd-thesis.pdf
+#
+# this gives the same hash as fetchgit, fetchFromGitiles and fetchFromGitHub
+# only for "simple" sources. we raise NativeHashUnsupported for
+# - submodules (fetchgit fetches them, git archive writes empty directories)
+# - .gitattributes which change files on checkout or in git archive
+#   (eol, text, filter, ident, export-ignore, export-subst)
+# - postFetch scripts other than "rm -r $out/some/path; "
+
+import base64
+import hashlib
+import os
+import re
+import shlex
+import stat
+import subprocess
+import sys
+import tempfile
+
+class NativeHashUnsupported(Exception):
+    pass
+
+# .gitattributes with these attributes can change the output of the fetcher
+gitattributes_pattern = re.compile(rb"\b(eol|text|crlf|filter|ident|export-ignore|export-subst)\b")
+
+chunk_size = 1024 * 1024
+
+class NarWriter:
+    # write a NAR stream into a hash object
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def write_bytes(self, data):
+        self.hasher.update(len(data).to_bytes(8, "little"))
+        self.hasher.update(data)
+        self.write_padding(len(data))
+
+    def write_padding(self, size):
+        if size % 8 != 0:
+            self.hasher.update(b"\0" * (8 - size % 8))
+
+    def write_str(self, string):
+        self.write_bytes(string.encode("utf8"))
+
+    def write_strs(self, *strings):
+        for string in strings:
+            self.write_str(string)
+
+    def write_regular(self, size, chunks, executable=False):
+        # chunks: iterable of bytes, with a total length of size
+        self.write_strs("(", "type", "regular")
+        if executable:
+            self.write_strs("executable", "")
+        self.write_str("contents")
+        self.hasher.update(size.to_bytes(8, "little"))
+        written = 0
+        for chunk in chunks:
+            self.hasher.update(chunk)
+            written += len(chunk)
+        if written != size:
+            raise Exception(f"NarWriter: expected {size} bytes, got {written} bytes")
+        self.write_padding(size)
+        self.write_str(")")
+
+    def write_symlink(self, target):
+        self.write_strs("(", "type", "symlink", "target")
+        self.write_bytes(target)
+        self.write_str(")")
+
+def sri_hash(hasher):
+    return "sha256-" + base64.b64encode(hasher.digest()).decode("ascii")
+
+def nar_hash_path(path):
+    # hash a file or directory on disk, like "nix hash path"
+    hasher = hashlib.sha256()
+    writer = NarWriter(hasher)
+    writer.write_str("nix-archive-1")
+    def write_node(path):
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            writer.write_symlink(os.fsencode(os.readlink(path)))
+        elif stat.S_ISREG(st.st_mode):
+            def read_chunks():
+                with open(path, "rb") as f:
+                    while chunk := f.read(chunk_size):
+                        yield chunk
+            writer.write_regular(st.st_size, read_chunks(), executable=bool(st.st_mode & stat.S_IXUSR))
+        elif stat.S_ISDIR(st.st_mode):
+            writer.write_strs("(", "type", "directory")
+            for name in sorted(os.listdir(os.fsencode(path))):
+                writer.write_strs("entry", "(", "name")
+                writer.write_bytes(name)
+                writer.write_str("node")
+                write_node(os.path.join(os.fsencode(path), name))
+                writer.write_str(")")
+            writer.write_str(")")
+        else:
+            raise NativeHashUnsupported(f"unsupported file type: {path}")
+    write_node(path)
+    return sri_hash(hasher)
+
+def parse_post_fetch(post_fetch):
+    # return the list of (path, force) removed by postFetch
+    # force: "rm -rf", a missing path is no error
+    # example: "rm -r $out/third_party/blink/web_tests; rm -r $out/content/test/data; "
+    remove_paths = []
+    for command in post_fetch.split(";"):
+        words = shlex.split(command)
+        if len(words) == 0:
+            continue
+        if len(words) != 3 or words[0] != "rm" or words[1] not in ("-r", "-rf") or not words[2].startswith("$out/"):
+            raise NativeHashUnsupported(f"unsupported postFetch command: {command.strip()}")
+        remove_paths.append((words[2][len("$out/"):].strip("/"), words[1] == "-rf"))
+    return remove_paths
+
+def git_tree_entries(git_dir, rev):
+    # return a nested dict: name -> (mode, object_id) or name -> dict
+    cmd = ["git", "-C", git_dir, "ls-tree", "-r", "-t", "-z", "--full-tree", rev]
+    out = subprocess.check_output(cmd)
+    root = {}
+    for line in out.split(b"\0"):
+        if not line:
+            continue
+        info, path = line.split(b"\t", 1)
+        mode, object_type, object_id = info.split(b" ")
+        *parents, name = path.split(b"/")
+        directory = root
+        for parent in parents:
+            directory = directory[parent]
+        if object_type == b"tree":
+            directory[name] = {}
+        elif object_type == b"commit":
+            raise NativeHashUnsupported(f"submodule at {path.decode()}")
+        else:
+            directory[name] = (mode, object_id)
+    return root
+
+def remove_tree_paths(root, remove_paths):
+    # remove_paths: list of (path, force), see parse_post_fetch
+    for remove_path, force in remove_paths:
+        *parents, name = remove_path.encode("utf8").split(b"/")
+        directory = root
+        for parent in parents:
+            directory = directory.get(parent)
+            if not isinstance(directory, dict):
+                break
+        else:
+            if name in directory:
+                del directory[name]
+                continue
+        if not force:
+            # "rm -r" fails on a missing path, so the fetcher fails
+            raise NativeHashUnsupported(f"postFetch removes a missing path: {remove_path}")
+
+def nar_hash_git_tree(git_dir, rev, remove_paths=()):
+    # hash the tree of a git revision, like the output of fetchgit
+    root = git_tree_entries(git_dir, rev)
+    remove_tree_paths(root, remove_paths)
+
+    hasher = hashlib.sha256()
+    writer = NarWriter(hasher)
+    cat_file = subprocess.Popen(["git", "-C", git_dir, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read_blob(object_id):
+        # return (size, chunks)
+        cat_file.stdin.write(object_id + b"\n")
+        cat_file.stdin.flush()
+        header = cat_file.stdout.readline().split()
+        if len(header) != 3 or header[1] != b"blob":
+            raise Exception(f"git cat-file: unexpected header {header}")
+        size = int(header[2])
+        def read_chunks():
+            remaining = size
+            while remaining > 0:
+                chunk = cat_file.stdout.read(min(remaining, chunk_size))
+                if not chunk:
+                    raise Exception("git cat-file: unexpected end of output")
+                remaining -= len(chunk)
+                yield chunk
+            # blob content is followed by a newline
+            cat_file.stdout.read(1)
+        return size, read_chunks()
+
+    def read_blob_bytes(object_id):
+        size, chunks = read_blob(object_id)
+        return b"".join(chunks)
+
+    def check_gitattributes(path, object_id):
+        if gitattributes_pattern.search(read_blob_bytes(object_id)):
+            raise NativeHashUnsupported(f"{path.decode()} can change files on checkout")
+
+    def write_node(path, node):
+        if isinstance(node, dict):
+            writer.write_strs("(", "type", "directory")
+            for name in sorted(node.keys()):
+                writer.write_strs("entry", "(", "name")
+                writer.write_bytes(name)
+                writer.write_str("node")
+                write_node(path + b"/" + name, node[name])
+                writer.write_str(")")
+            writer.write_str(")")
+            return
+        mode, object_id = node
+        if mode == b"120000":
+            writer.write_symlink(read_blob_bytes(object_id))
+        elif mode in (b"100644", b"100755", b"100664"):
+            if path.endswith(b"/.gitattributes"):
+                check_gitattributes(path, object_id)
+            size, chunks = read_blob(object_id)
+            writer.write_regular(size, chunks, executable=(mode == b"100755"))
+        else:
+            raise NativeHashUnsupported(f"unsupported git mode {mode.decode()} at {path.decode()}")
+
+    try:
+        writer.write_str("nix-archive-1")
+        write_node(b"", root)
+    finally:
+        cat_file.stdin.close()
+        cat_file.wait()
+    return sri_hash(hasher)
+
+# known answer for self_check: the NAR of known_answer_files, written by hand.
+# every string is its length (8 bytes, little endian), the bytes, and zero padding to 8 bytes
+known_answer_files = {
+    # path: (content, executable) or symlink target
+    "README": (b"hello\n", False),
+    "bin/run": (b"#!/bin/sh\n", True),
+    "link": "README",
+}
+known_answer_nar = (
+    b"\x0d\x00\x00\x00\x00\x00\x00\x00nix-archive-1\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00type\x00\x00\x00\x00"
+    b"\x09\x00\x00\x00\x00\x00\x00\x00directory\x00\x00\x00\x00\x00\x00\x00"
+    b"\x05\x00\x00\x00\x00\x00\x00\x00entry\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00name\x00\x00\x00\x00"
+    b"\x06\x00\x00\x00\x00\x00\x00\x00README\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00node\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00type\x00\x00\x00\x00"
+    b"\x07\x00\x00\x00\x00\x00\x00\x00regular\x00"
+    b"\x08\x00\x00\x00\x00\x00\x00\x00contents"
+    b"\x06\x00\x00\x00\x00\x00\x00\x00hello\x0a\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x05\x00\x00\x00\x00\x00\x00\x00entry\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00name\x00\x00\x00\x00"
+    b"\x03\x00\x00\x00\x00\x00\x00\x00bin\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00node\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00type\x00\x00\x00\x00"
+    b"\x09\x00\x00\x00\x00\x00\x00\x00directory\x00\x00\x00\x00\x00\x00\x00"
+    b"\x05\x00\x00\x00\x00\x00\x00\x00entry\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00name\x00\x00\x00\x00"
+    b"\x03\x00\x00\x00\x00\x00\x00\x00run\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00node\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00type\x00\x00\x00\x00"
+    b"\x07\x00\x00\x00\x00\x00\x00\x00regular\x00"
+    b"\x0a\x00\x00\x00\x00\x00\x00\x00executable\x00\x00\x00\x00\x00\x00"
+    b"\x00\x00\x00\x00\x00\x00\x00\x00"
+    b"\x08\x00\x00\x00\x00\x00\x00\x00contents"
+    b"\x0a\x00\x00\x00\x00\x00\x00\x00#!/bin/sh\x0a\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x05\x00\x00\x00\x00\x00\x00\x00entry\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00name\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00link\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00node\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00(\x00\x00\x00\x00\x00\x00\x00"
+    b"\x04\x00\x00\x00\x00\x00\x00\x00type\x00\x00\x00\x00"
+    b"\x07\x00\x00\x00\x00\x00\x00\x00symlink\x00"
+    b"\x06\x00\x00\x00\x00\x00\x00\x00target\x00\x00"
+    b"\x06\x00\x00\x00\x00\x00\x00\x00README\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+    b"\x01\x00\x00\x00\x00\x00\x00\x00)\x00\x00\x00\x00\x00\x00\x00"
+)
+
+def self_check():
+    # hash known_answer_files from disk and from git,
+    # and compare with the hash of known_answer_nar.
+    # a mistake in the serializer would write wrong hashes to sources.json and to the cache
+    expected = sri_hash(hashlib.sha256(known_answer_nar))
+    with tempfile.TemporaryDirectory(prefix="gclient2nix-nar-check-") as tempdir:
+        tree = tempdir + "/tree"
+        for path, value in known_answer_files.items():
+            path = tree + "/" + path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if isinstance(value, str):
+                os.symlink(value, path)
+                continue
+            content, executable = value
+            with open(path, "wb") as f:
+                f.write(content)
+            os.chmod(path, 0o755 if executable else 0o644)
+        git_dir = tempdir + "/git"
+        git = ["git", "--git-dir", git_dir, "--work-tree", tree]
+        subprocess.check_call([*git, "init", "--quiet"])
+        subprocess.check_call([*git, "add", "--all"])
+        rev = subprocess.check_output([*git, "write-tree"]).decode("utf8").strip()
+        hashes = {
+            "nar_hash_path": nar_hash_path(tree),
+            "nar_hash_git_tree": nar_hash_git_tree(git_dir, rev),
+        }
+    for name, hash in hashes.items():
+        if hash != expected:
+            raise Exception(f"native hash self check failed: {name} returned {hash}, expected {expected}")
+
+def git_source_hash(url, rev, remove_paths=()):
+    # fetch one revision and hash it
+    # return None if the source is not supported
+    # this runs in a worker process, see gclient2nix.native_hash
+    with tempfile.TemporaryDirectory(prefix="gclient2nix-nar-") as git_dir:
+        def git(*args):
+            cmd = ["git", "-C", git_dir, *args]
+            print(shlex.join(cmd), file=sys.stderr)
+            subprocess.check_call(cmd)
+        git("init", "--quiet", "--bare")
+        git("fetch", "--quiet", "--depth=1", "--no-tags", url, rev)
+        try:
+            return nar_hash_git_tree(git_dir, rev, remove_paths)
+        except NativeHashUnsupported as e:
+            print(f"native hash: {url} {rev}: {e}", file=sys.stderr)
+            return None
@@ -0,0 +1,107 @@
+# batched nix evaluation of nixpkgs attributes
+#
+# every "nix eval" call imports nixpkgs again, which takes some seconds.
+# here, requests from many threads are collected,
+# and all pending attributes are evaluated with one "nix eval" call.
+# pool_size: number of parallel "nix eval" calls
+# runner: ProcessRunner, see process_runner.py. None: use subprocess
+#
+# for every attribute, we get the arguments of the derivation,
+# including outputHash, and the store path as __outPath
+
+import json
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from . import trace
+
+# hack: use overrideAttrs to get the arguments for derivation
+# note: we must rename outPath to __outPath, otherwise "nix eval" would reduce the src attribute-set to the outPath string
+get_src_attrs_expr = 'src: let src2 = src.overrideAttrs (attrs: { passthru = { inherit attrs; }; }); in src2.attrs // { __outPath = src2.outPath; }'
+
+class NixEvaluator:
+    def __init__(self, nix_bin="nix", pool_size=1, batch_delay=0.05, runner=None):
+        self.nix_bin = nix_bin
+        self.runner = runner
+        self.pool_size = max(1, pool_size)
+        # wait for more requests before starting "nix eval"
+        self.batch_delay = batch_delay
+        # (nixpkgs_attr, future)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.workers = []
+        self.stopped = False
+        self.eval_count = 0
+
+    def get_src_attrs(self, nixpkgs_attr):
+        # return the arguments of the derivation, and __outPath
+        future = Future()
+        with self.condition:
+            if self.stopped:
+                raise Exception("NixEvaluator is stopped")
+            self.pending.append((nixpkgs_attr, future))
+            # start workers on demand
+            if len(self.workers) < self.pool_size:
+                worker = threading.Thread(target=self.work, daemon=True)
+                self.workers.append(worker)
+                worker.start()
+            self.condition.notify()
+        return future.result()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped and not self.pending:
+                    return
+            time.sleep(self.batch_delay)
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+            if batch:
+                self.eval_batch(batch)
+
+    def eval_batch(self, batch):
+        try:
+            results = self.eval_attrs([nixpkgs_attr for nixpkgs_attr, _ in batch])
+        except subprocess.CalledProcessError as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # one attribute can break the evaluation of all attributes
+            # so we evaluate them one by one, to get the errors of every attribute
+            for item in batch:
+                self.eval_batch([item])
+            return
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for idx, (_, future) in enumerate(batch):
+            future.set_result(results[idx])
+
+    def eval_attrs(self, nixpkgs_attrs):
+        # return a list of src attrs
+        nix_expr = f"with import <nixpkgs> {{}}; let get = {get_src_attrs_expr}; in {{\n"
+        for idx, nixpkgs_attr in enumerate(nixpkgs_attrs):
+            nix_expr += f"  a{idx} = get ({nixpkgs_attr});\n"
+        nix_expr += "}"
+        cmd = [self.nix_bin, "eval", "--impure", "--json", "--expr", nix_expr]
+        print(shlex.join(cmd), file=sys.stderr)
+        with trace.span("nix eval", count=len(nixpkgs_attrs)):
+            out = self.runner.check_output(cmd) if self.runner else subprocess.check_output(cmd)
+        self.eval_count += 1
+        results = json.loads(out.decode('utf-8'))
+        return [results[f"a{idx}"] for idx in range(len(nixpkgs_attrs))]
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
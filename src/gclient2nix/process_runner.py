@@ -0,0 +1,164 @@
+# asyncio core for external tools
+#
+# the calls of nix-universal-prefetch, nix-build, nix eval, nix path-info, bsdtar, tar, git,
+# nix-store, prefetch-yarn-deps, prefetch-npm-deps and nix-prefetch-git go through one ProcessRunner.
+# not in the runner:
+# - archive_index.scan_archive, which streams the stdout of bsdtar into tarfile
+# - nar.py, which runs in the worker processes of native hashing
+# - the "python -m gclient2nix.git_mirror" commands
+#
+# the processes are started with asyncio.create_subprocess_exec
+# on an event loop in a background thread,
+# so the worker threads of PrefetchPipeline only wait for results.
+#
+# - max_processes: global limit of parallel processes
+# - tool_limits: limits per tool, for example { "nix-build": 2 }
+# - cancel: kill all running processes and fail all waiting calls,
+#   on the first fatal error (see resolve_deps)
+# - stderr is streamed line by line to our stderr, prefixed with the tool name,
+#   and the last lines are kept for the error message
+#
+# in a forked child process, the loop thread does not exist,
+# so there the calls fall back to subprocess.run
+
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+
+class Cancelled(Exception):
+    pass
+
+class ProcessRunner:
+    def __init__(self, max_processes=1, tool_limits=None, stderr_tail_lines=20):
+        self.max_processes = max(1, max_processes)
+        # tool name -> maximum number of parallel processes of this tool
+        self.tool_limits = dict(tool_limits or {})
+        self.stderr_tail_lines = stderr_tail_lines
+        self.loop = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.semaphore = None
+        self.tool_semaphores = {}
+        self.processes = set()
+        self.cancelled = False
+        self.process_count = 0
+        # pid of the process with the loop thread
+        self.pid = None
+
+    def start(self):
+        with self.start_lock:
+            if self.loop is not None:
+                return
+            self.pid = os.getpid()
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="process_runner", daemon=True)
+            self.thread.start()
+
+    def check_output(self, cmd, tool=None, cwd=None, quiet=False, first_line=False):
+        # like subprocess.check_output. can be called from any thread, except the loop thread
+        returncode, stdout, stderr = self.run(cmd, tool, cwd, quiet, first_line)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+        return stdout
+
+    def run(self, cmd, tool=None, cwd=None, quiet=False, first_line=False):
+        # return (returncode, stdout, stderr tail)
+        # quiet: dont print stderr
+        # first_line: read only the first line of stdout, then kill the process. like "cmd | head -n1"
+        if self.pid is not None and self.pid != os.getpid():
+            # forked child process
+            proc = subprocess.run(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout = proc.stdout.split(b"\n", 1)[0] + b"\n" if first_line and proc.stdout else proc.stdout
+            return proc.returncode, stdout, proc.stderr
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self.run_async(cmd, tool, cwd, quiet, first_line), self.loop)
+        return future.result()
+
+    def get_tool_semaphore(self, tool):
+        # called in the loop thread
+        if not tool in self.tool_limits:
+            return None
+        if not tool in self.tool_semaphores:
+            self.tool_semaphores[tool] = asyncio.Semaphore(max(1, self.tool_limits[tool]))
+        return self.tool_semaphores[tool]
+
+    async def run_async(self, cmd, tool=None, cwd=None, quiet=False, first_line=False):
+        tool = tool or os.path.basename(cmd[0])
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_processes)
+        tool_semaphore = self.get_tool_semaphore(tool)
+        if tool_semaphore:
+            await tool_semaphore.acquire()
+        try:
+            async with self.semaphore:
+                if self.cancelled:
+                    raise Cancelled(f"cancelled: {cmd[0]}")
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                )
+                self.processes.add(proc)
+                self.process_count += 1
+                try:
+                    stderr_task = asyncio.ensure_future(self.stream_stderr(proc, tool, quiet))
+                    if first_line:
+                        stdout = await proc.stdout.readline()
+                        try:
+                            proc.kill()
+                        except ProcessLookupError:
+                            pass
+                    else:
+                        stdout = await proc.stdout.read()
+                    stderr = await stderr_task
+                    returncode = await proc.wait()
+                    if first_line and stdout:
+                        # killed after the first line
+                        returncode = 0
+                finally:
+                    self.processes.discard(proc)
+        finally:
+            if tool_semaphore:
+                tool_semaphore.release()
+        if self.cancelled and returncode != 0:
+            raise Cancelled(f"cancelled: {cmd[0]}")
+        return returncode, stdout, stderr
+
+    async def stream_stderr(self, proc, tool, quiet=False):
+        # return the last lines of stderr
+        tail = []
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                break
+            if not quiet:
+                sys.stderr.write(f"{tool}: {line.decode('utf8', 'replace').rstrip()}\n")
+            tail.append(line)
+            if len(tail) > self.stderr_tail_lines:
+                tail.pop(0)
+        return b"".join(tail)
+
+    def cancel(self):
+        # kill all running processes. waiting and later calls raise Cancelled
+        self.cancelled = True
+        if self.loop is None:
+            return
+        def kill_all():
+            for proc in list(self.processes):
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+        self.loop.call_soon_threadsafe(kill_all)
+
+    def stop(self):
+        with self.start_lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+            self.semaphore = None
+            self.tool_semaphores = {}
@@ -0,0 +1,146 @@
+# size-aware scheduling of prefetch jobs
+#
+# large sources like chromium/src or v8 take the longest time to prefetch.
+# when they start last, the parallel run waits for them at the end.
+# so PrefetchPipeline starts the largest sources first (longest processing time first),
+# and the small sources fill in around them.
+#
+# the size of a source is the recorded store_path_size of the same source.
+# for a new revision, the size is estimated from other revisions of the same url,
+# then from other sources on the same host, then default_size.
+# the same estimates give the ETA of PrefetchProgress, and the duration in --plan
+
+import heapq
+import statistics
+import threading
+import time
+import urllib.parse
+
+# estimated size of a source without any history
+default_size = 10 * 1024 * 1024
+
+# bytes per second of one prefetch job, without any recorded prefetch_time
+default_rate = 4 * 1024 * 1024
+
+# seconds per prefetched source, for the start of nix
+source_overhead = 2.0
+
+def host_of_url(url):
+    return urllib.parse.urlsplit(url).netloc
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
+
+class SizeEstimator:
+    def __init__(self, default_size=default_size):
+        self.default_size = default_size
+        # url -> list of sizes
+        self.url_sizes = {}
+        # host -> list of sizes
+        self.host_sizes = {}
+        self.lock = threading.Lock()
+        self.estimates = {}
+        # sum of sizes and prefetch times of sources with a recorded prefetch_time
+        self.timed_size = 0
+        self.timed_time = 0
+
+    def add(self, url, size, prefetch_time=None):
+        with self.lock:
+            self.url_sizes.setdefault(url, []).append(size)
+            self.host_sizes.setdefault(host_of_url(url), []).append(size)
+            self.estimates = {}
+            if prefetch_time:
+                self.timed_size += size
+                self.timed_time += prefetch_time
+
+    def rate(self):
+        # bytes per second of one prefetch job
+        if self.timed_time <= 0 or self.timed_size <= 0:
+            return default_rate
+        return self.timed_size / self.timed_time
+
+    def estimate(self, url):
+        # median size of other revisions of the same url, or of the same host
+        if url is None:
+            return self.default_size
+        with self.lock:
+            if url in self.estimates:
+                return self.estimates[url]
+            if url in self.url_sizes:
+                size = statistics.median(self.url_sizes[url])
+            elif host_of_url(url) in self.host_sizes:
+                size = statistics.median(self.host_sizes[host_of_url(url)])
+            else:
+                size = self.default_size
+            self.estimates[url] = int(size)
+            return self.estimates[url]
+
+def estimate_duration(sizes, jobs, rate):
+    # makespan of longest-first scheduling on "jobs" parallel jobs, in seconds
+    # sizes of 0 are sources without prefetch
+    finish_times = [0.0] * max(1, jobs)
+    for size in sorted(sizes, reverse=True):
+        if size <= 0:
+            break
+        heapq.heapreplace(finish_times, finish_times[0] + source_overhead + size / rate)
+    return max(finish_times)
+
+class PrefetchProgress:
+    # print progress and ETA of the prefetch jobs
+    # the rate is the estimated size of the finished sources per second of wall-clock time
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = None
+        self.last_print = 0
+        self.total_count = 0
+        self.total_size = 0
+        self.done_count = 0
+        self.done_size = 0
+
+    def add(self, size):
+        with self.lock:
+            self.total_count += 1
+            self.total_size += size
+
+    def started(self):
+        with self.lock:
+            if self.start is None:
+                self.start = time.monotonic()
+                self.last_print = self.start
+
+    def done(self, size):
+        with self.lock:
+            self.done_count += 1
+            self.done_size += size
+            now = time.monotonic()
+            if now - self.last_print < self.interval or self.total_size == 0:
+                return
+            self.last_print = now
+            print(f"prefetch progress: {self.done_count} of {self.total_count} sources, {self.format_eta(now)}")
+
+    def eta(self, now=None):
+        # seconds until all known sources are done, or None
+        elapsed = (now or time.monotonic()) - (self.start or 0)
+        if self.start is None or self.done_size == 0 or elapsed <= 0:
+            return None
+        rate = self.done_size / elapsed
+        return max(0, self.total_size - self.done_size) / rate
+
+    def format_eta(self, now=None):
+        size_str = f"{format_size(self.done_size)} of {format_size(self.total_size)} estimated"
+        eta = self.eta(now)
+        if eta is None:
+            return size_str
+        return f"{size_str}, ETA {format_duration(eta)}"
@@ -0,0 +1,158 @@
+# size of store paths, for store_path_size
+#
+# "du -sb" traverses the whole store path again, right after nix has written it.
+# nix already knows the size: "nix path-info --json" returns the NAR size
+# of many store paths with one call.
+# when nix path-info fails (no nix command, or not a valid store path)
+# then the NAR size is computed from a parallel os.scandir walker.
+# both ways return the same value: the size of the NAR serialization,
+# like "narSize" in "nix path-info --json".
+# note: old versions of gclient2nix recorded the "du -sb" size (apparent size).
+# these sizes have store_path_size_unit "du", the new sizes have "nar"
+#
+# store paths are immutable, so the sizes are cached by store path
+
+import json
+import os
+import shlex
+import stat
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import trace
+
+# maximum number of store paths per "nix path-info" call
+path_info_batch_size = 500
+
+def str_size(length):
+    # a string in a NAR: the length as 8 bytes, then the bytes, padded to a multiple of 8
+    return 8 + (length + 7) // 8 * 8
+
+def strs_size(*strings):
+    return sum(str_size(len(string)) for string in strings)
+
+# NAR framing, see nar.NarWriter
+nar_header_size = strs_size("nix-archive-1")
+directory_size = strs_size("(", "type", "directory", ")")
+# plus the name and the node of the entry
+entry_size = strs_size("entry", "(", "name", "node", ")")
+# plus the contents
+regular_size = strs_size("(", "type", "regular", "contents", ")")
+executable_size = strs_size("executable", "")
+# plus the target
+symlink_size = strs_size("(", "type", "symlink", "target", ")")
+
+def node_size(path, st):
+    # NAR size of a file or symlink
+    if stat.S_ISLNK(st.st_mode):
+        return symlink_size + str_size(len(os.fsencode(os.readlink(path))))
+    size = regular_size + str_size(st.st_size)
+    if st.st_mode & stat.S_IXUSR:
+        size += executable_size
+    return size
+
+def tree_size(path):
+    # NAR size of a directory, without the NAR header
+    total = 0
+    stack = [path]
+    while stack:
+        dir_path = stack.pop()
+        total += directory_size
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                total += entry_size + str_size(len(os.fsencode(entry.name)))
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += node_size(entry.path, entry.stat(follow_symlinks=False))
+    return total
+
+class StoreSizeProvider:
+    def __init__(self, nix_bin="nix", runner=None, jobs=4):
+        self.nix_bin = nix_bin
+        # ProcessRunner, see process_runner.py. None: use subprocess
+        self.runner = runner
+        # number of threads of the walker
+        self.jobs = jobs
+        # store path -> size
+        self.sizes = {}
+        self.lock = threading.Lock()
+        # False after nix was not found
+        self.use_path_info = True
+
+    def get_sizes(self, store_paths):
+        # return a dict: store path -> size
+        with self.lock:
+            missing = [path for path in dict.fromkeys(store_paths) if not path in self.sizes]
+        sizes = {}
+        if missing and self.use_path_info:
+            for start in range(0, len(missing), path_info_batch_size):
+                sizes |= self.get_nar_sizes(missing[start:start + path_info_batch_size])
+        for path in missing:
+            if not path in sizes:
+                with trace.span("walk store path"):
+                    sizes[path] = self.walk_size(path)
+        with self.lock:
+            self.sizes |= sizes
+            return { path: self.sizes[path] for path in store_paths }
+
+    def get_nar_sizes(self, store_paths):
+        # return a dict: store path -> NAR size
+        # invalid store paths are missing in the result
+        cmd = [self.nix_bin, "path-info", "--json", *store_paths]
+        print(shlex.join(cmd[:3]) + f" ... ({len(store_paths)} store paths)", file=sys.stderr)
+        try:
+            with trace.span("nix path-info", count=len(store_paths)):
+                if self.runner:
+                    out = self.runner.check_output(cmd)
+                else:
+                    out = subprocess.check_output(cmd)
+            path_infos = json.loads(out)
+        except FileNotFoundError:
+            print(f"store_size: {self.nix_bin} not found, measuring store paths with the walker")
+            self.use_path_info = False
+            return {}
+        except subprocess.CalledProcessError as e:
+            if len(store_paths) == 1:
+                print(f"store_size: nix path-info failed with exit status {e.returncode}, measuring {store_paths[0]} with the walker")
+                return {}
+            # one invalid store path fails the whole call.
+            # retry both halves, so the valid store paths still get their size from nix
+            print(f"store_size: nix path-info failed with exit status {e.returncode}, retrying {len(store_paths)} store paths in two halves")
+            half = len(store_paths) // 2
+            return self.get_nar_sizes(store_paths[:half]) | self.get_nar_sizes(store_paths[half:])
+        except ValueError as e:
+            print(f"store_size: invalid output of nix path-info, measuring store paths with the walker: {e}")
+            return {}
+        # old versions of nix return a list of objects with "path"
+        # new versions return an object: store path -> path info or null
+        if isinstance(path_infos, list):
+            path_infos = { path_info.get("path"): path_info for path_info in path_infos }
+        return {
+            path: path_infos[path]["narSize"]
+            for path in store_paths
+            if isinstance(path_infos.get(path), dict) and isinstance(path_infos[path].get("narSize"), int)
+        }
+
+    def walk_size(self, store_path):
+        # NAR size of the store path
+        # the subdirectories of the top-level directory are walked in parallel
+        st = os.lstat(store_path)
+        if not stat.S_ISDIR(st.st_mode):
+            # archive or single file
+            return nar_header_size + node_size(store_path, st)
+        total = nar_header_size + directory_size
+        subdirs = []
+        with os.scandir(store_path) as entries:
+            for entry in entries:
+                total += entry_size + str_size(len(os.fsencode(entry.name)))
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    total += node_size(entry.path, entry.stat(follow_symlinks=False))
+        if len(subdirs) <= 1 or self.jobs <= 1:
+            return total + sum(tree_size(path) for path in subdirs)
+        with ThreadPoolExecutor(max_workers=min(self.jobs, len(subdirs))) as executor:
+            return total + sum(executor.map(tree_size, subdirs))
@@ -0,0 +1,86 @@
+# timing of the phases of gclient2nix, see --trace
+#
+# every span is written as a "complete event" in the chrome trace_event format
+# open the trace file in chrome://tracing or https://ui.perfetto.dev
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+#
+# spans in the worker processes of native hashing are not recorded
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+enabled = False
+
+# (name, start, end, thread_id, args)
+events = []
+events_lock = threading.Lock()
+thread_names = {}
+
+start_time = time.perf_counter()
+
+def enable():
+    global enabled
+    global start_time
+    enabled = True
+    start_time = time.perf_counter()
+
+@contextmanager
+def span(name, **args):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        thread = threading.current_thread()
+        with events_lock:
+            events.append((name, start, end, thread.ident, args))
+            thread_names[thread.ident] = thread.name
+
+def write(path):
+    pid = os.getpid()
+    trace_events = []
+    # thread ids are large numbers, chrome wants small numbers
+    tids = { thread_id: tid for tid, thread_id in enumerate(thread_names, 1) }
+    with events_lock:
+        for thread_id, tid in tids.items():
+            trace_events.append({ "name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": { "name": thread_names[thread_id] } })
+        for name, start, end, thread_id, args in events:
+            trace_events.append({
+                "name": name,
+                "ph": "X",
+                "ts": round((start - start_time) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "pid": pid,
+                "tid": tids[thread_id],
+                "args": args,
+            })
+    with open(path, "w") as f:
+        json.dump({ "traceEvents": trace_events, "displayTimeUnit": "ms" }, f)
+        f.write("\n")
+
+def percentile(sorted_values, p):
+    # nearest-rank method
+    idx = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[int(idx)]
+
+def print_summary():
+    durations = {}
+    with events_lock:
+        for name, start, end, thread_id, args in events:
+            durations.setdefault(name, []).append(end - start)
+    rows = []
+    for name, values in durations.items():
+        values.sort()
+        rows.append((name, len(values), sum(values), percentile(values, 50), percentile(values, 95)))
+    # slowest phase first
+    rows.sort(key=lambda row: row[2], reverse=True)
+    name_width = max([len("span")] + [len(row[0]) for row in rows])
+    print(f"{'span':<{name_width}}  {'count':>7}  {'total':>9}  {'p50':>9}  {'p95':>9}")
+    for name, count, total, p50, p95 in rows:
+        print(f"{name:<{name_width}}  {count:>7}  {total:>8.3f}s  {p50:>8.3f}s  {p95:>8.3f}s")